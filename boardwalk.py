@@ -19,65 +19,714 @@
 # SOFTWARE.
 
 #!/usr/bin/env python3
-from struct import unpack
-import sys
-
-# Edit this variable with board IDs of boards you want to see fully decoded.
-decode_full = []
-
-f = open(sys.argv[1], 'rb')
-f.seek(0x2)
-board_count = unpack('<H', f.read(2))[0]
-
-f.seek(0x200)
-for i in range(0, board_count + 1):
-	board_pos = f.tell()
-	board_len = unpack('<H', f.read(2))[0]
-	print(f"Board {i}, position = {board_pos} bytes, length = {board_len} bytes")
-	if (board_len < 128) or (board_len >= 32768):
-		print(f"Unusual board length!")
-	board_next_pos = f.tell() + board_len
-
-	f.seek(f.tell() + 51) # board name
-	if i in decode_full:
-		# decode RLE
-		tile_to_find = 1500
-		tile_id = 0
-		while tile_to_find > 0:
-			tile_pos = f.tell()
-			tile_count, tile_element, tile_color = unpack('BBB', f.read(3))
+from bisect import bisect_right
+from collections import namedtuple
+from struct import iter_unpack, pack, unpack, unpack_from
+import argparse, glob, hashlib, json, mmap, os, re, sys, zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+WORLD_HEADER_SIZE = 0x200
+BOARD_TITLE_SIZE = 51
+BOARD_TILES = 60 * 25
+BOARD_INFO_SIZE = 86
+STAT_SIZE = 33
+STAT_FORMAT = "<BBhhhBBBhhBBIhhII"
+ELEMENT_COUNT = 54
+MAX_STAT_COUNT = 151
+# offset of the current (starting) board in the world header
+HEADER_CURRENT_BOARD = 0x11
+E_PASSAGE = 11
+
+_RUN_BYTES = [bytes((v,)) for v in range(256)]
+_VALID_ELEMENTS = bytes(range(ELEMENT_COUNT))
+
+# Cheap pre-filter for resynchronisation: a length word from 128 to 32767, a
+# title length of at most 50 and a valid element in the first RLE run. The
+# length word rules out zero-filled stretches, the most common damage.
+_BOARD_HEADER_RE = re.compile(rb"(?=(?:[\x80-\xff]\x00|.[\x01-\x7f])[\x00-\x32].{50}.[\x00-\x35])", re.DOTALL)
+
+# Offsets are absolute positions in the world file. rle_end and stat_offset
+# are None if the RLE stream runs past the end of the file.
+BoardEntry = namedtuple("BoardEntry", [
+	"id", "position", "length", "title_offset", "rle_end", "rle_tiles", "stat_offset", "next_position"
+])
+
+Stat = namedtuple("Stat", [
+	"x", "y", "step_x", "step_y", "cycle", "p1", "p2", "p3", "follower", "leader",
+	"under_element", "under_color", "data", "data_pos", "data_len", "unk1", "unk2"
+])
+
+DecodedBoard = namedtuple("DecodedBoard", ["title", "elements", "colors", "info", "stats", "code"])
+
+def scan_board(data, board_id, board_pos):
+	board_len = unpack_from('<H', data, board_pos)[0]
+	title_pos = board_pos + 2
+	rle_pos = title_pos + BOARD_TITLE_SIZE
+	# every third byte of the RLE stream is a run length
+	tiles = 0
+	rle_end = None
+	for n, count in enumerate(data[rle_pos:rle_pos + BOARD_TILES * 3:3]):
+		tiles += count or 256
+		if tiles >= BOARD_TILES:
+			rle_end = rle_pos + (n + 1) * 3
+			break
+	stat_pos = None
+	if rle_end is not None and rle_end <= len(data):
+		stat_pos = rle_end + BOARD_INFO_SIZE
+	else:
+		rle_end = None
+	return BoardEntry(board_id, board_pos, board_len, title_pos, rle_end, tiles, stat_pos, title_pos + board_len)
+
+def is_plausible_board(data, entry):
+	# A plausible board has a sane length and title, an RLE stream of exactly
+	# 1500 tiles of valid elements, and at most 151 stats which fit inside the
+	# board's length.
+	if (entry.length < 128) or (entry.length >= 32768) or (entry.next_position > len(data)):
+		return False
+	if (data[entry.title_offset] >= BOARD_TITLE_SIZE) or (entry.rle_tiles != BOARD_TILES):
+		return False
+	# the last run can reach 1500 tiles with its element and color past the end
+	if (entry.stat_offset is None) or (entry.stat_offset + 2 > entry.next_position):
+		return False
+	rle_pos = entry.title_offset + BOARD_TITLE_SIZE
+	if len(data[rle_pos + 1:entry.rle_end:3].translate(None, _VALID_ELEMENTS)) > 0:
+		return False
+	end = stat_table_end(data, entry.stat_offset, entry.next_position)
+	return (end is not None) and (end <= entry.next_position)
+
+def stat_table_end(data, stat_offset, limit):
+	# Returns the end of the stat table (and its code) at stat_offset, or
+	# None if it has over 151 stats or runs past limit.
+	stat_count = unpack_from('<H', data, stat_offset)[0]
+	if stat_count > MAX_STAT_COUNT:
+		return None
+	stat_pos = stat_offset + 2
+	for istat in range(0, stat_count + 1):
+		if stat_pos + STAT_SIZE > limit:
+			return None
+		stat_pos += STAT_SIZE + max(unpack_from('<h', data, stat_pos + 23)[0], 0)
+	return stat_pos if stat_pos <= limit else None
+
+def fix_board_length(data, entry):
+	# For a board whose length word is wrong but whose title, RLE and stats
+	# are plausible, returns the entry with the length taken from the end of
+	# its stat table; otherwise None.
+	if (entry.stat_offset is None) or (entry.stat_offset + 2 > len(data)):
+		return None
+	end = stat_table_end(data, entry.stat_offset, len(data))
+	if end is None:
+		return None
+	fixed = entry._replace(length=end - entry.title_offset, next_position=end)
+	if (fixed.length == entry.length) or not is_plausible_board(data, fixed):
+		return None
+	return fixed
+
+def empty_board(title):
+	# A board with the player in the top left corner and nothing else, used
+	# in place of boards lost while repairing a world.
+	title = title.encode('cp437')[:BOARD_TITLE_SIZE - 1]
+	body = bytes([len(title)]) + title.ljust(BOARD_TITLE_SIZE - 1, b"\0")
+	body += bytes([1, 4, 0x1F]) + bytes(3) * 5 + bytes([BOARD_TILES - 1 - 1280, 0, 0])
+	body += pack('<BBBBBBB', 255, 0, 0, 0, 0, 0, 0) + bytes(59) + pack('<BBh', 1, 1, 0) + bytes(16)
+	body += pack('<H', 0)
+	body += pack(STAT_FORMAT, 1, 1, 0, 0, 1, 0, 0, 0, -1, -1, 0, 0, 0, 0, 0, 0, 0)
+	return pack('<H', len(body)) + body
+
+def find_next_board(data, board_id, board_pos):
+	# Single forward pass: the regex pre-filter runs over the buffer in C and
+	# only its candidates are fully checked.
+	for m in _BOARD_HEADER_RE.finditer(data, board_pos):
+		board_len = unpack_from('<H', data, m.start())[0]
+		if (board_len < 128) or (board_len >= 32768) or (m.start() + 2 + board_len > len(data)):
+			continue
+		entry = scan_board(data, board_id, m.start())
+		if is_plausible_board(data, entry):
+			return entry
+	return None
+
+class WorldIndex:
+	def __init__(self, filename, resync=False):
+		self.file = open(filename, 'rb')
+		self.data = None
+		try:
+			# an empty file cannot be mapped at all
+			if os.fstat(self.file.fileno()).st_size < 4:
+				raise ValueError("world header is truncated")
+			self._walk(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ), resync)
+		except Exception:
+			self.close()
+			raise
+
+	@classmethod
+	def from_bytes(cls, data, resync=False):
+		index = cls.__new__(cls)
+		index.file = None
+		index._walk(data, resync)
+		return index
+
+	@classmethod
+	def from_board(cls, record, board_id, board_pos):
+		# Indexes a single length-prefixed board record read from a stream.
+		# Offsets in the entry are relative to the record; base holds its
+		# position in the world.
+		index = cls.__new__(cls)
+		index.file = None
+		index.data = record
+		index.base = board_pos
+		index.board_count = None
+		index.boards = [scan_board(record, board_id, 0)]
+		index.gaps = []
+		index.lost = []
+		index.ids_guessed = False
+		index.fixed_lengths = {}
+		return index
+
+	def _walk(self, data, resync):
+		self.data = data
+		self.base = 0
+		if len(self.data) < 4:
+			raise ValueError("world header is truncated")
+		self.board_count = unpack_from('<H', self.data, 0x2)[0]
+		self.boards = []
+		# (start, end, lost ID) byte ranges skipped while resynchronising. A
+		# gap counted as a lost board has its ID (also listed in lost), so the
+		# IDs of the boards after it stay as they were; otherwise it is None.
+		self.gaps = []
+		self.lost = []
+		# set if the header board count does not tell which gaps lost a board
+		self.ids_guessed = False
+		# board ID -> original length word, for boards whose length was rederived
+		self.fixed_lengths = {}
+		board_pos = WORLD_HEADER_SIZE
+		if resync:
+			# the board count may be corrupt as well, so walk until the end of the file
+			gaps = []
+			fixed_lengths = {}
+			while board_pos + 2 <= len(self.data):
+				entry = scan_board(self.data, len(self.boards), board_pos)
+				if not is_plausible_board(self.data, entry):
+					fixed = fix_board_length(self.data, entry)
+					if fixed is not None:
+						fixed_lengths[len(self.boards)] = entry.length
+						entry = fixed
+					else:
+						# (start, end, number of boards recovered before it)
+						next_entry = find_next_board(self.data, len(self.boards), board_pos + 1)
+						if next_entry is None:
+							gaps.append((board_pos, len(self.data), len(self.boards)))
+							break
+						gaps.append((board_pos, next_entry.position, len(self.boards)))
+						entry = next_entry
+				self.boards.append(entry)
+				board_pos = entry.next_position
+			self._number_boards(gaps, fixed_lengths)
+			return
+		for i in range(0, self.board_count + 1):
+			if board_pos + 2 > len(self.data):
+				break
+			entry = scan_board(self.data, i, board_pos)
+			self.boards.append(entry)
+			board_pos = entry.next_position
+
+	def _number_boards(self, gaps, fixed_lengths):
+		# How many boards a gap lost is not known, so the header board count
+		# decides: no gap counts if every board was recovered, otherwise the
+		# largest gaps count as one lost board each. If the count does not
+		# match either way, the IDs after the first gap are a guess.
+		missing = self.board_count + 1 - len(self.boards)
+		by_size = sorted(range(len(gaps)), key=lambda n: gaps[n][0] - gaps[n][1])
+		lost_gaps = set(by_size[:max(missing, 0)])
+		self.ids_guessed = (len(gaps) > 0) and (missing not in (0, len(gaps)))
+		boards = self.boards
+		self.boards = []
+		gap_iter = iter(enumerate(gaps))
+		gap = next(gap_iter, None)
+		for i in range(0, len(boards) + 1):
+			while (gap is not None) and (gap[1][2] == i):
+				n, (start, end, recovered) = gap
+				lost_id = None
+				if n in lost_gaps:
+					lost_id = i + len(self.lost)
+					self.lost.append(lost_id)
+				self.gaps.append((start, end, lost_id))
+				gap = next(gap_iter, None)
+			if i < len(boards):
+				board_id = i + len(self.lost)
+				self.boards.append(boards[i]._replace(id=board_id))
+				if i in fixed_lengths:
+					self.fixed_lengths[board_id] = fixed_lengths[i]
+
+	def walk(self):
+		for i in range(0, len(self.boards)):
+			yield self, i
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return len(self.boards)
+
+	def __getitem__(self, board_id):
+		return self.boards[board_id]
+
+	def close(self):
+		if self.file is not None:
+			if self.data is not None:
+				self.data.close()
+			self.file.close()
+
+	def write_world(self, filename):
+		# Writes the world header and the indexed boards, with the board count
+		# and rederived lengths fixed up. Lost boards are written as empty
+		# boards, so every board keeps its ID.
+		entries = {entry.id: entry for entry in self.boards}
+		board_total = len(self.boards) + len(self.lost)
+		with open(filename, 'wb') as f:
+			f.write(self.data[0:0x2])
+			f.write(pack('<H', max(board_total - 1, 0)))
+			f.write(self.data[0x4:WORLD_HEADER_SIZE])
+			for board_id in range(board_total):
+				entry = entries.get(board_id)
+				if entry is None:
+					f.write(empty_board("(lost board %d)" % board_id))
+				else:
+					f.write(pack('<H', entry.length))
+					f.write(self.data[entry.title_offset:entry.next_position])
+
+	def title(self, board_id):
+		entry = self.boards[board_id]
+		if entry.title_offset >= len(self.data):
+			return ""
+		title_len = min(self.data[entry.title_offset], BOARD_TITLE_SIZE - 1)
+		return self.data[entry.title_offset + 1:entry.title_offset + 1 + title_len].decode('cp437')
+
+	def iter_runs(self, board_id):
+		# yields (position, count, element, color); stops after the run reaching 1500 tiles
+		entry = self.boards[board_id]
+		tile_pos = entry.title_offset + BOARD_TITLE_SIZE
+		tile_to_find = BOARD_TILES
+		while tile_to_find > 0 and tile_pos + 3 <= len(self.data):
+			tile_count, tile_element, tile_color = unpack_from('BBB', self.data, tile_pos)
 			if tile_count == 0:
 				tile_count = 256
+			yield tile_pos, tile_count, tile_element, tile_color
 			tile_to_find -= tile_count
-			print(f"Tile {tile_id} at {tile_pos} bytes: {tile_count} x ({tile_element}, {tile_color})")
-			if (tile_element >= 54):
-				print(f"Unusual element!")
-			tile_id += 1
-		if tile_to_find < 0:
-			tiles_too_many = -tile_to_find
-			print(f"Invalid ending tile count ({tiles_too_many} tiles too many)!")
-		else:
-			tile_pos = f.tell()
-			print(f"RLE ending found at {tile_pos} bytes.")
-		f.seek(f.tell() + 86) # board info
-		stat_count = unpack('<H', f.read(2))[0]
-		print(f"stat count = {stat_count}")
-		if stat_count > 151:
-			print("Unusual stat count!")
-		# decode stats
+			tile_pos += 3
+
+	def elements_at(self, board_id, positions):
+		# Returns the element under each 1-based (x, y) of positions (None if
+		# off the board), found by bisecting the run start offsets instead of
+		# expanding the board.
+		run_starts = []
+		run_elements = []
+		tile = 0
+		for pos, count, element, color in self.iter_runs(board_id):
+			run_starts.append(tile)
+			run_elements.append(element)
+			tile += count
+		result = []
+		for x, y in positions:
+			if (x < 1) or (x > 60) or (y < 1) or (y > 25) or (len(run_starts) == 0):
+				result.append(None)
+			else:
+				result.append(run_elements[bisect_right(run_starts, (x - 1) + (y - 1) * 60) - 1])
+		return result
+
+	def exits(self, board_id):
+		# returns [north, south, west, east] (0 means no exit), or None if the board info is missing
+		entry = self.boards[board_id]
+		if (entry.rle_end is None) or (entry.rle_end + 6 > len(self.data)):
+			return None
+		return list(self.data[entry.rle_end + 2:entry.rle_end + 6])
+
+	def stat_count(self, board_id):
+		entry = self.boards[board_id]
+		if entry.stat_offset is None or entry.stat_offset + 2 > len(self.data):
+			return None
+		return unpack_from('<H', self.data, entry.stat_offset)[0]
+
+	def iter_stats(self, board_id):
+		# yields (position, Stat, code); code is the raw OOP bytes following the stat
+		entry = self.boards[board_id]
+		stat_count = self.stat_count(board_id)
+		if stat_count is None:
+			return
+		stat_pos = entry.stat_offset + 2
 		for istat in range(0, stat_count + 1):
-			stat_pos = f.tell()
-			stat_x, stat_y, stat_stepx, stat_stepy, stat_cycle, \
-			stat_p1, stat_p2, stat_p3, stat_follower, stat_leader, \
-			stat_under_element, stat_under_color, stat_data, \
-			stat_datapos, stat_datalen, stat_unk1, \
-			stat_unk2 = unpack("<BBhhhBBBhhBBIhhII", f.read(33))
-			print(f"stat {istat} @ {stat_pos} bytes, {stat_x}, {stat_y} pos")
-			if (stat_x > 60) or (stat_y > 25) or (stat_x < 1) or (stat_y < 1):
-				print("Unusual X/Y position!")
-			if stat_datalen > 0:
-				f.read(stat_datalen)
-
-	f.seek(board_next_pos)
-
-f.close()
+			if stat_pos + STAT_SIZE > len(self.data):
+				return
+			stat = Stat._make(unpack_from(STAT_FORMAT, self.data, stat_pos))
+			code_pos = stat_pos + STAT_SIZE
+			code_len = max(stat.data_len, 0)
+			yield stat_pos, stat, self.data[code_pos:code_pos + code_len]
+			stat_pos = code_pos + code_len
+
+	def decode_board(self, board_id):
+		entry = self.boards[board_id]
+		rle_pos = entry.title_offset + BOARD_TITLE_SIZE
+		rle_end = entry.rle_end
+		if rle_end is None:
+			rle_end = rle_pos + (len(self.data) - rle_pos) // 3 * 3
+		rle = self.data[rle_pos:rle_end]
+		# the RLE stream is split into its three columns and expanded run by run
+		counts = [c or 256 for c in rle[0::3]]
+		elements = bytearray(b"".join([_RUN_BYTES[e] * c for c, e in zip(counts, rle[1::3])])[:BOARD_TILES])
+		colors = bytearray(b"".join([_RUN_BYTES[e] * c for c, e in zip(counts, rle[2::3])])[:BOARD_TILES])
+		if len(elements) < BOARD_TILES:
+			elements.extend(bytes(BOARD_TILES - len(elements)))
+			colors.extend(bytes(BOARD_TILES - len(colors)))
+		info = None
+		if entry.rle_end is not None:
+			info = self.data[entry.rle_end:entry.rle_end + BOARD_INFO_SIZE]
+		stats, code = self.unpack_stats(board_id)
+		return DecodedBoard(self.title(board_id), elements, colors, info, stats, code)
+
+	def unpack_stats(self, board_id):
+		# Stats without code are contiguous, so each code-free run of the stat
+		# table is unpacked with a single iter_unpack call.
+		stats = []
+		code = []
+		stat_count = self.stat_count(board_id)
+		if stat_count is None:
+			return stats, code
+		stat_count += 1
+		stat_pos = self.boards[board_id].stat_offset + 2
+		while len(stats) < stat_count:
+			table_len = min((stat_count - len(stats)) * STAT_SIZE, len(self.data) - stat_pos)
+			table_len -= table_len % STAT_SIZE
+			if table_len <= 0:
+				break
+			for stat in iter_unpack(STAT_FORMAT, self.data[stat_pos:stat_pos + table_len]):
+				stat = Stat._make(stat)
+				stats.append(stat)
+				stat_pos += STAT_SIZE
+				if stat.data_len > 0:
+					code.append(self.data[stat_pos:stat_pos + stat.data_len])
+					stat_pos += stat.data_len
+					break
+				code.append(b"")
+		return stats, code
+
+	def record(self, board_id):
+		entry = self.boards[board_id]
+		record = {
+			"board": entry.id,
+			"position": self.base + entry.position,
+			"length": entry.length,
+			"title": self.title(board_id)
+		}
+		record.update(self.check_board(board_id))
+		return record
+
+	def check_board(self, board_id):
+		entry = self.boards[board_id]
+		board = self.decode_board(board_id)
+		stat_count = self.stat_count(board_id)
+		return {
+			"unusual_length": (entry.length < 128) or (entry.length >= 32768),
+			"rle_overrun": max(entry.rle_tiles - BOARD_TILES, 0),
+			"rle_truncated": entry.rle_end is None,
+			"unusual_elements": len(board.elements.translate(None, _VALID_ELEMENTS)),
+			"stat_count": stat_count,
+			"unusual_stat_count": (stat_count is not None) and (stat_count > MAX_STAT_COUNT),
+			"unusual_xy": [istat for istat, stat in enumerate(board.stats)
+				if (stat.x > 60) or (stat.y > 25) or (stat.x < 1) or (stat.y < 1)]
+		}
+
+class WorldStream:
+	# Forward-only reader for non-seekable sources (zip members, stdin).
+	# Boards are length-prefixed, so each one is read with two reads and
+	# indexed on its own.
+	def __init__(self, f):
+		self.file = f
+		self.header = f.read(WORLD_HEADER_SIZE)
+		if len(self.header) < 4:
+			raise ValueError("world header is truncated")
+		self.board_count = unpack_from('<H', self.header, 0x2)[0]
+		self.gaps = []
+		self.lost = []
+		self.ids_guessed = False
+		self.fixed_lengths = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self.file.close()
+
+	def walk(self):
+		board_pos = WORLD_HEADER_SIZE
+		for i in range(0, self.board_count + 1):
+			record = self.file.read(2)
+			if len(record) < 2:
+				return
+			record += self.file.read(unpack('<H', record)[0])
+			yield WorldIndex.from_board(record, i, board_pos), 0
+			board_pos += len(record)
+
+def open_worlds(path, resync=False):
+	# Yields (name, world) pairs. Plain files are memory-mapped; "-" (stdin),
+	# zip archives and "archive.zip:MEMBER.ZZT" are streamed without being
+	# extracted. Resynchronising needs random access, so streams are then
+	# read into memory instead.
+	def open_stream(name, f):
+		if resync:
+			with f:
+				return WorldIndex.from_bytes(f.read(), resync=True)
+		return WorldStream(f)
+
+	if path == "-":
+		yield "<stdin>", open_stream("<stdin>", sys.stdin.buffer)
+		return
+	zip_path, member = path, None
+	if not os.path.exists(path) and (":" in path):
+		zip_path, member = path.rsplit(":", 1)
+	if (member is not None) or (os.path.isfile(path) and path.lower().endswith(".zip")):
+		with zipfile.ZipFile(zip_path) as zf:
+			if member is not None:
+				# raises KeyError if the member does not exist
+				yield f"{zip_path}:{member}", open_stream(member, zf.open(member))
+				return
+			for name in zf.namelist():
+				if name.lower().endswith(".zzt"):
+					yield f"{zip_path}:{name}", open_stream(name, zf.open(name))
+		return
+	yield path, WorldIndex(path, resync=resync)
+
+def print_board(index, i, verbose):
+	entry = index[i]
+	base = index.base
+	print(f"Board {entry.id}, position = {base + entry.position} bytes, length = {entry.length} bytes")
+	if (entry.length < 128) or (entry.length >= 32768):
+		print(f"Unusual board length!")
+	if not verbose:
+		return
+	# decode RLE
+	tile_to_find = BOARD_TILES
+	tile_id = 0
+	for tile_pos, tile_count, tile_element, tile_color in index.iter_runs(i):
+		tile_to_find -= tile_count
+		print(f"Tile {tile_id} at {base + tile_pos} bytes: {tile_count} x ({tile_element}, {tile_color})")
+		if (tile_element >= ELEMENT_COUNT):
+			print(f"Unusual element!")
+		tile_id += 1
+	if tile_to_find < 0:
+		tiles_too_many = -tile_to_find
+		print(f"Invalid ending tile count ({tiles_too_many} tiles too many)!")
+	elif entry.rle_end is not None:
+		print(f"RLE ending found at {base + entry.rle_end} bytes.")
+	stat_count = index.stat_count(i)
+	if stat_count is None:
+		print("Board data ends before the stat table!")
+		return
+	print(f"stat count = {stat_count}")
+	if stat_count > MAX_STAT_COUNT:
+		print("Unusual stat count!")
+	# decode stats
+	for istat, (stat_pos, stat, stat_code) in enumerate(index.iter_stats(i)):
+		print(f"stat {istat} @ {base + stat_pos} bytes, {stat.x}, {stat.y} pos")
+		if (stat.x > 60) or (stat.y > 25) or (stat.x < 1) or (stat.y < 1):
+			print("Unusual X/Y position!")
+
+def print_board_checks(index, i):
+	result = index.check_board(i)
+	if result["rle_overrun"] > 0:
+		print(f"Invalid ending tile count ({result['rle_overrun']} tiles too many)!")
+	if result["rle_truncated"]:
+		print("Board data ends before the RLE ending!")
+	elif result["stat_count"] is None:
+		print("Board data ends before the stat table!")
+	if result["unusual_elements"] > 0:
+		print(f"Unusual element! ({result['unusual_elements']} tiles)")
+	if result["unusual_stat_count"]:
+		print(f"Unusual stat count! ({result['stat_count']})")
+	for istat in result["unusual_xy"]:
+		print(f"Unusual X/Y position! (stat {istat})")
+
+def file_hash(filename):
+	h = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+def scan_records(filename):
+	# Returns the board records of every world in filename. A world which
+	# cannot be read ends its records with an error record instead.
+	records = []
+	name = filename
+	try:
+		for name, world in open_worlds(filename):
+			with world:
+				for index, i in world.walk():
+					record = {"file": name}
+					record.update(index.record(i))
+					records.append(record)
+	except Exception as e:
+		records.append({"file": name, "error": str(e) or type(e).__name__})
+	return records
+
+def scan_world(filename, cached=None):
+	# Returns the cache entry for one world file (or zip archive). If the
+	# file's hash matches the cached entry, the cached records are reused.
+	try:
+		st = os.stat(filename)
+		entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "hash": file_hash(filename), "records": []}
+	except OSError as e:
+		# never matches on the next scan, so the file is retried
+		return {"size": None, "mtime": None, "hash": None, "records": [{"file": filename, "error": str(e)}]}
+	if (cached is not None) and (cached["hash"] == entry["hash"]):
+		entry["records"] = cached["records"]
+		return entry
+	entry["records"] = scan_records(filename)
+	return entry
+
+def find_worlds(paths):
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				dirs.sort()
+				for name in sorted(files):
+					if name.lower().endswith((".zzt", ".zip")):
+						yield os.path.join(root, name)
+		elif glob.has_magic(path):
+			yield from sorted(glob.glob(path, recursive=True))
+		else:
+			yield path
+
+def load_cache(filename):
+	if (filename is None) or not os.path.exists(filename):
+		return {}
+	with open(filename, "r") as f:
+		return json.load(f)
+
+def save_cache(filename, cache):
+	with open(filename + ".tmp", "w") as f:
+		json.dump(cache, f)
+	os.replace(filename + ".tmp", filename)
+
+def scan_worlds(filenames, jobs=None, cache_filename=None):
+	# Yields board records for every world, scanning changed files in a
+	# process pool. Files whose size and mtime match the cache are skipped
+	# without being read. Stdin and archive members ("archive.zip:MEMBER")
+	# are not files, so they are scanned here and never cached.
+	cache = load_cache(cache_filename)
+	scan_args = []
+	for filename in filenames:
+		if (filename == "-") or not os.path.exists(filename):
+			scan_args.append((filename, None, None, False))
+			continue
+		key = os.path.abspath(filename)
+		cached = cache.get(key)
+		unchanged = False
+		if cached is not None:
+			try:
+				st = os.stat(filename)
+				unchanged = (cached["size"] == st.st_size) and (cached["mtime"] == st.st_mtime_ns)
+			except OSError:
+				pass
+		scan_args.append((filename, key, cached, unchanged))
+	with ProcessPoolExecutor(jobs) as executor:
+		futures = [None if (key is None) or unchanged else executor.submit(scan_world, filename, cached)
+			for filename, key, cached, unchanged in scan_args]
+		for (filename, key, cached, unchanged), future in zip(scan_args, futures):
+			if key is None:
+				yield from scan_records(filename)
+				continue
+			if unchanged:
+				entry = cached
+			else:
+				try:
+					entry = future.result()
+				except Exception as e:
+					# the worker itself failed; report it without caching
+					yield {"file": filename, "error": str(e) or type(e).__name__}
+					continue
+			cache[key] = entry
+			yield from entry["records"]
+	if cache_filename is not None:
+		save_cache(cache_filename, cache)
+
+def main():
+	parser = argparse.ArgumentParser(description="Walk over a .ZZT file, trying to detect irregularities.")
+	parser.add_argument("-d", "--decode", type=int, action="append", default=[], metavar="ID",
+		help="board ID to print tile by tile (can be given multiple times)")
+	parser.add_argument("-n", "--no-decode", action="store_true",
+		help="only walk board lengths, skipping the full decode checks")
+	parser.add_argument("-r", "--resync", action="store_true",
+		help="on a corrupt board, scan forward for the next plausible board header")
+	parser.add_argument("-o", "--repair", default=None, metavar="FILE",
+		help="with --resync, write the recovered boards to a new world FILE")
+	parser.add_argument("--jsonl", action="store_true",
+		help="scan all given worlds in parallel, printing one JSON record per board")
+	parser.add_argument("-j", "--jobs", type=int, default=None,
+		help="number of worker processes for --jsonl (default: CPU count)")
+	parser.add_argument("--cache", default=None, metavar="FILE",
+		help="cache --jsonl results in FILE, skipping unchanged worlds on re-scan")
+	parser.add_argument("files", nargs="+", metavar="file",
+		help="world file, zip archive (optionally archive.zip:MEMBER.ZZT), directory, glob pattern or - for stdin")
+	args = parser.parse_args()
+
+	filenames = list(find_worlds(args.files))
+	if args.repair is not None:
+		# every world would be written to the same file
+		if not args.resync:
+			parser.error("-o/--repair requires -r/--resync")
+		if len(filenames) != 1:
+			parser.error("-o/--repair takes a single world")
+		if os.path.isfile(filenames[0]) and filenames[0].lower().endswith(".zip"):
+			with zipfile.ZipFile(filenames[0]) as zf:
+				if len([name for name in zf.namelist() if name.lower().endswith(".zzt")]) != 1:
+					parser.error("-o/--repair takes a single world, use archive.zip:MEMBER.ZZT")
+	if args.jsonl:
+		for record in scan_worlds(filenames, args.jobs, args.cache):
+			print(json.dumps(record))
+		return
+
+	multiple = len(filenames) > 1
+	status = 0
+	for filename in filenames:
+		try:
+			for name, world in open_worlds(filename, resync=args.resync):
+				if multiple or (name not in (filename, "<stdin>")):
+					print(f"== {name} ==")
+				with world:
+					gaps = {end: (start, lost_id) for start, end, lost_id in world.gaps}
+					board_total = 0
+					for index, i in world.walk():
+						entry = index[i]
+						if entry.position in gaps:
+							start, lost_id = gaps[entry.position]
+							print(f"Resynchronised: skipped {entry.position - start} bytes from {start}"
+								+ (" (no board lost)." if lost_id is None else f" (board {lost_id} lost)."))
+						if entry.id in world.fixed_lengths:
+							print(f"Board {entry.id}: length word {world.fixed_lengths[entry.id]} is wrong, using {entry.length}.")
+						print_board(index, i, entry.id in args.decode)
+						if not args.no_decode and entry.id not in args.decode:
+							print_board_checks(index, i)
+						board_total += 1
+					if args.resync:
+						if len(world.gaps) > 0 and world.gaps[-1][1] == len(world.data):
+							start, end, lost_id = world.gaps[-1]
+							print(f"Resynchronised: no board found in the last {end - start} bytes"
+								+ (" (no board lost)." if lost_id is None else f" (board {lost_id} lost)."))
+						if world.ids_guessed:
+							print("The header board count does not match the skipped stretches, so the lost boards and the"
+								" IDs after them are a guess.")
+						print(f"Recovered {board_total} boards (header says {world.board_count + 1}).")
+						if args.repair is not None:
+							world.write_world(args.repair)
+		except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+			# report the broken world and carry on with the others
+			print(f"{filename}: error: {e}", file=sys.stderr)
+			status = 1
+	sys.exit(status)
+
+if __name__ == "__main__":
+	main()
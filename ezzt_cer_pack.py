@@ -0,0 +1,161 @@
+# Copyright (c) 2026 Adrian Siekierka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#!/usr/bin/env python3
+from struct import pack, unpack
+import argparse, os, re, sys
+
+from ezzt_cer_unpack import CerArchive, CerEntry, COPY_CHUNK_SIZE, F_ENTRY_SIZE, copy_range
+
+def parse_asset_arg(text):
+	# "INDEX=FILE", or a file named asset{INDEX}.dat
+	if "=" in text:
+		index, filename = text.split("=", 1)
+		return int(index), filename
+	m = re.fullmatch(r"asset(\d+)\.dat", os.path.basename(text), re.IGNORECASE)
+	if m is None:
+		raise argparse.ArgumentTypeError(f"cannot tell the asset index of {text}, use INDEX=FILE")
+	return int(m.group(1)), text
+
+def read_entries(f):
+	f.seek(0)
+	file_entry_count = unpack('<H', f.read(2))[0]
+	return [CerEntry._make(unpack('<HII', f.read(F_ENTRY_SIZE))) for i in range(0, file_entry_count)]
+
+def write_entries(f, entries):
+	f.seek(0)
+	f.write(pack('<H', len(entries)))
+	for f_entry in entries:
+		f.write(pack('<HII', *f_entry))
+
+def pack_archive(filename, assets, base=None):
+	# Writes a .CER file from {index: filename}, taking every other asset from
+	# the base CerArchive. Data is copied file to file in chunks, so memory
+	# use does not depend on the asset sizes.
+	sources = {}
+	if base is not None:
+		for f_entry in base:
+			sources[f_entry.index] = (base.file.fileno(), f_entry.offset, f_entry.size)
+	files = []
+	try:
+		for index, asset_filename in assets.items():
+			af = open(asset_filename, 'rb')
+			files.append(af)
+			sources[index] = (af.fileno(), 0, os.fstat(af.fileno()).st_size)
+		if len(sources) > 0xFFFF:
+			raise ValueError(f"too many assets ({len(sources)})")
+		entries = []
+		offset = 2 + len(sources) * F_ENTRY_SIZE
+		for index in sorted(sources):
+			entries.append(CerEntry(index, offset, sources[index][2]))
+			offset += sources[index][2]
+		if offset > 0xFFFFFFFF:
+			raise ValueError("archive would be larger than 4 GiB")
+		with open(filename, 'wb') as of:
+			write_entries(of, entries)
+			of.flush()
+			for f_entry in entries:
+				src_fd, src_offset, size = sources[f_entry.index]
+				if copy_range(src_fd, of.fileno(), src_offset, size) != size:
+					raise ValueError(f"asset {f_entry.index} is truncated")
+		return entries
+	finally:
+		for af in files:
+			af.close()
+
+def move_range(fd, start, end, delta):
+	# Moves [start, end) by delta bytes in chunks, back to front when moving
+	# forward so that no chunk overwrites data not yet moved.
+	if delta > 0:
+		chunk_end = end
+		while chunk_end > start:
+			chunk_start = max(start, chunk_end - COPY_CHUNK_SIZE)
+			os.pwrite(fd, os.pread(fd, chunk_end - chunk_start, chunk_start), chunk_start + delta)
+			chunk_end = chunk_start
+	elif delta < 0:
+		chunk_start = start
+		while chunk_start < end:
+			chunk_end = min(end, chunk_start + COPY_CHUNK_SIZE)
+			os.pwrite(fd, os.pread(fd, chunk_end - chunk_start, chunk_start), chunk_start + delta)
+			chunk_start = chunk_end
+
+def replace_asset(filename, index, asset_filename):
+	# Replaces one asset in place: only the data after it is moved and the
+	# file entry table is rewritten.
+	with open(filename, 'r+b') as f, open(asset_filename, 'rb') as af:
+		entries = read_entries(f)
+		matches = [e for e in entries if e.index == index]
+		if len(matches) == 0:
+			raise ValueError(f"asset {index} not found")
+		old_entry = matches[0]
+		new_size = os.fstat(af.fileno()).st_size
+		delta = new_size - old_entry.size
+		file_size = os.fstat(f.fileno()).st_size
+		tail_start = old_entry.offset + old_entry.size
+		if tail_start > file_size:
+			raise ValueError(f"asset {index} ends past the end of the file")
+		move_range(f.fileno(), tail_start, file_size, delta)
+		if delta < 0:
+			f.truncate(file_size + delta)
+		f.seek(old_entry.offset)
+		f.flush()
+		if copy_range(af.fileno(), f.fileno(), 0, new_size) != new_size:
+			raise ValueError(f"{asset_filename} is truncated")
+		entries = [
+			old_entry._replace(size=new_size) if e is old_entry
+			else e._replace(offset=e.offset + delta) if e.offset >= tail_start
+			else e
+			for e in entries
+		]
+		write_entries(f, entries)
+		return entries
+
+def main():
+	parser = argparse.ArgumentParser(description="Pack ZZT Enhancer .CER files.")
+	parser.add_argument("-b", "--base", default=None, metavar="ARCHIVE",
+		help="take all assets not given on the command line from ARCHIVE")
+	parser.add_argument("-r", "--replace", action="store_true",
+		help="replace the given assets in the output archive in place")
+	parser.add_argument("output")
+	parser.add_argument("assets", nargs="*", type=parse_asset_arg, metavar="asset",
+		help="asset{INDEX}.dat or INDEX=FILE")
+	args = parser.parse_args()
+
+	try:
+		if args.replace:
+			for index, asset_filename in args.assets:
+				replace_asset(args.output, index, asset_filename)
+			return
+		if (args.base is not None) and os.path.exists(args.output) and os.path.samefile(args.base, args.output):
+			raise ValueError("the base archive cannot be overwritten, use --replace")
+		base = CerArchive(args.base) if args.base is not None else None
+		try:
+			entries = pack_archive(args.output, dict(args.assets), base)
+		finally:
+			if base is not None:
+				base.close()
+		for f_entry in entries:
+			print(f"Asset {f_entry.index}, offset = {f_entry.offset}, size = {f_entry.size} bytes")
+	except (OSError, ValueError) as e:
+		print(f"error: {e}", file=sys.stderr)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
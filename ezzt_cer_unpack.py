@@ -19,21 +19,163 @@
 # SOFTWARE.
 
 #!/usr/bin/env python3
-from struct import unpack
-import sys
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from struct import iter_unpack, unpack_from
+import argparse, mmap, os, sys
 
-f = open(sys.argv[1], 'rb')
-file_entry_count = unpack('<H', f.read(2))[0]
-file_entries = []
+F_ENTRY_SIZE = 10
+COPY_CHUNK_SIZE = 1 << 20
 
-for i in range(0, file_entry_count):
-	f_index, f_offs, f_size = unpack('<HII', f.read(10))
-	print(f"Asset {f_index}, offset = {f_offs}, size = {f_size} bytes")
-	file_entries.append((f_index, f_offs, f_size))
+CerEntry = namedtuple("CerEntry", ["index", "offset", "size"])
 
-for f_entry in file_entries:
-	f.seek(f_entry[1])
-	with open(f'asset{f_entry[0]}.dat', 'wb') as of:
-		of.write(f.read(f_entry[2]))
+def copy_range(src_fd, dst_fd, offset, size):
+	# Copies in-kernel with copy_file_range or sendfile where the platform
+	# allows it, falling back to a buffered copy for whatever is left (also
+	# when a method stops short without an error). Returns the number of
+	# bytes copied, which is less than size only at the end of the source.
+	copied = 0
+	for method in ("copy_file_range", "sendfile"):
+		if not hasattr(os, method):
+			continue
+		try:
+			while copied < size:
+				if method == "copy_file_range":
+					n = os.copy_file_range(src_fd, dst_fd, size - copied, offset + copied)
+				else:
+					n = os.sendfile(dst_fd, src_fd, offset + copied, size - copied)
+				if n <= 0:
+					break
+				copied += n
+		except OSError:
+			continue
+		if copied >= size:
+			return copied
+	while copied < size:
+		chunk = os.pread(src_fd, min(COPY_CHUNK_SIZE, size - copied), offset + copied)
+		if len(chunk) <= 0:
+			break
+		os.write(dst_fd, chunk)
+		copied += len(chunk)
+	return copied
 
-f.close()
+def parse_index_ranges(text):
+	# "1-5,8" -> {1, 2, 3, 4, 5, 8}
+	indices = set()
+	for part in text.split(","):
+		first, sep, last = part.partition("-")
+		indices.update(range(int(first), int(last if sep else first) + 1))
+	return indices
+
+class CerArchive:
+	# Parses the f_entry table once and serves assets straight from the
+	# memory-mapped file. Views returned by asset() must be released before
+	# the archive is closed.
+	def __init__(self, filename, cache_size=16):
+		self.file = open(filename, 'rb')
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.view = memoryview(self.data)
+		file_entry_count = unpack_from('<H', self.data, 0)[0]
+		table = self.data[2:2 + file_entry_count * F_ENTRY_SIZE]
+		if len(table) < file_entry_count * F_ENTRY_SIZE:
+			raise ValueError(f"file entry table is truncated ({file_entry_count} entries)")
+		self.entries = [CerEntry._make(e) for e in iter_unpack('<HII', table)]
+		self.entries_by_index = {e.index: e for e in self.entries}
+		self.cache_size = cache_size
+		self.cache = OrderedDict()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __iter__(self):
+		return iter(self.entries)
+
+	def __contains__(self, index):
+		return index in self.entries_by_index
+
+	def close(self):
+		self.cache.clear()
+		self.view.release()
+		self.data.close()
+		self.file.close()
+
+	def invalid_entries(self):
+		# (entry, reason) for every entry pointing outside the file data
+		data_start = 2 + len(self.entries) * F_ENTRY_SIZE
+		result = []
+		for f_entry in self.entries:
+			if f_entry.offset < data_start:
+				result.append((f_entry, "offset inside the file entry table"))
+			elif f_entry.offset + f_entry.size > len(self.data):
+				result.append((f_entry, f"data ends {f_entry.offset + f_entry.size - len(self.data)} bytes past the end of the file"))
+		return result
+
+	def extract(self, output_dir=".", indices=None, jobs=None):
+		# Writes the selected assets (default: all) to output_dir/asset{index}.dat,
+		# in file order. Raises ValueError before writing anything if any
+		# selected entry is invalid.
+		entries = [e for e in self.entries if (indices is None) or (e.index in indices)]
+		invalid = [(e, reason) for e, reason in self.invalid_entries() if e in entries]
+		if len(invalid) > 0:
+			raise ValueError("; ".join(f"asset {e.index}: {reason}" for e, reason in invalid))
+		entries.sort(key=lambda e: e.offset)
+		os.makedirs(output_dir, exist_ok=True)
+
+		def extract_entry(f_entry):
+			filename = os.path.join(output_dir, f'asset{f_entry.index}.dat')
+			with open(filename, 'wb') as of:
+				if copy_range(self.file.fileno(), of.fileno(), f_entry.offset, f_entry.size) != f_entry.size:
+					raise ValueError(f"asset {f_entry.index} is truncated")
+			return filename
+
+		with ThreadPoolExecutor(jobs) as executor:
+			return list(executor.map(extract_entry, entries))
+
+	def asset(self, index):
+		# zero-copy view of an asset's data
+		f_entry = self.entries_by_index[index]
+		return self.view[f_entry.offset:f_entry.offset + f_entry.size]
+
+	def read(self, index, decoder=bytes):
+		# decoder(view) is called once per asset; the results of the most
+		# recently used cache_size calls are kept
+		key = (index, decoder)
+		if key in self.cache:
+			self.cache.move_to_end(key)
+			return self.cache[key]
+		with self.asset(index) as view:
+			value = decoder(view)
+		self.cache[key] = value
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return value
+
+def main():
+	parser = argparse.ArgumentParser(description="Unpack ZZT Enhancer .CER files.")
+	parser.add_argument("-o", "--output-dir", default=".",
+		help="directory to write asset{index}.dat files to")
+	parser.add_argument("-i", "--index", type=parse_index_ranges, default=None, metavar="RANGES",
+		help="only extract the given asset indices, for example 1-5,8")
+	parser.add_argument("-j", "--jobs", type=int, default=None,
+		help="number of extraction threads")
+	parser.add_argument("file")
+	args = parser.parse_args()
+
+	with CerArchive(args.file) as archive:
+		for f_entry in archive:
+			print(f"Asset {f_entry.index}, offset = {f_entry.offset}, size = {f_entry.size} bytes")
+
+		try:
+			archive.extract(args.output_dir, args.index, args.jobs)
+		except ValueError as e:
+			print(f"error: {e}", file=sys.stderr)
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
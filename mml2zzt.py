@@ -19,8 +19,10 @@
 # SOFTWARE.
 
 #!/usr/bin/env python3
-import argparse, copy, sys
+import argparse, functools, hashlib, heapq, io, os, re, sys
 import pprint
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 DEFAULT_MML_QUIRK = "mabi"
 ZZT_LINE_LENGTH = 36
@@ -58,34 +60,71 @@ zzt_note_notes = {
 	11: "b"
 }
 
-def p_next_char(text):
-	return text[0:1], text[1:]
+# command, note modifier, number (None if absent), dotted, position in text
+MmlToken = namedtuple("MmlToken", ["command", "modifier", "value", "dotted", "position"])
 
-def p_next_number(text, defval):
-	i = 0
-	while (text[0:(i+1)].isnumeric()) and (i < len(text)):
-		i += 1
-	if i > 0:
-		return int(text[0:i]), text[i:]
-	else:
-		return defval, text
-
-def p_next_length(text, defval):
-	i = 0
-	while text[i:(i+1)].isnumeric() and (i < len(text)):
-		i += 1
-	if i > 0:
-		if text[(i):(i+1)] == '.':
-			return (64.0 / int(text[0:i])) * 1.5, text[(i+1):]
+_MML_TOKEN_RE = re.compile(r"([a-gA-G])([+#-]?)(\d*)(\.?)|([lLrRpP])(\d*)(\.?)|([tTvVoOnN])(\d*)|(.)", re.DOTALL)
+
+def tokenize_mml(text):
+	# Single pass over the original string; every character belongs to exactly one token.
+	for m in _MML_TOKEN_RE.finditer(text):
+		note, modifier, note_value, note_dot, length_cmd, length_value, length_dot, number_cmd, number_value, other = m.groups()
+		if note is not None:
+			yield MmlToken(note.lower(), modifier, int(note_value) if note_value else None, note_dot == ".", m.start())
+		elif length_cmd is not None:
+			yield MmlToken(length_cmd.lower(), "", int(length_value) if length_value else None, length_dot == ".", m.start())
+		elif number_cmd is not None:
+			yield MmlToken(number_cmd.lower(), "", int(number_value) if number_value else None, False, m.start())
 		else:
-			return (64.0 / int(text[0:i])), text[i:]
+			yield MmlToken(other.lower(), "", None, False, m.start())
+
+def mml_number(token, defval):
+	if token.value is not None:
+		return token.value
+	return defval
+
+def mml_length(token, defval):
+	if token.value is not None:
+		length = 64.0 / token.value
 	else:
-		if text[0:1] == '.':
-			return defval * 1.5, text[1:]
-		else:
-			return defval, text
+		length = defval
+	if token.dotted:
+		length *= 1.5
+	return length
+
+class IrCommand:
+	# A "note", "pause" or "set_tempo" command. Fields a command does not use
+	# (octave/note for pauses, volume/octave/note for set_tempo) are None.
+	__slots__ = ("name", "volume", "octave", "note", "tempo", "length")
+
+	def __init__(self, name, volume=None, octave=None, note=None, tempo=None, length=0):
+		self.name = name
+		self.volume = volume
+		self.octave = octave
+		self.note = note
+		self.tempo = tempo
+		self.length = length
+
+	def __repr__(self):
+		return "IrCommand(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__ if getattr(self, k) is not None)
+
+class IrBlock:
+	# A joined block; notes refers to the IrCommands sounding during it, whose
+	# own length and tempo are not used.
+	__slots__ = ("length", "tempo", "notes")
 
-def _parse_mml_to_single_ir(text, quirk):
+	def __init__(self, length, tempo, notes):
+		self.length = length
+		self.tempo = tempo
+		self.notes = notes
+
+	def __repr__(self):
+		return "IrBlock(length=%r, tempo=%r, notes=%r)" % (self.length, self.tempo, self.notes)
+
+def _no_log(*args, **kwargs):
+	pass
+
+def _parse_mml_to_single_ir(text, quirk, log=print):
 	cmds = []
 	cmd_chr_notes = {"a": 9, "b": 11, "c": 0, "d": 2, "e": 4, "f": 5, "g": 7}
 	cmd_chr_note_modifiers = {"+": 1, "#": 1, "-": -1}
@@ -96,22 +135,17 @@ def _parse_mml_to_single_ir(text, quirk):
 		"volume": 8,
 		"tie": False
 	}
-	while len(text) > 0:
-		cmd = {}
-		cmd_chr, text = p_next_char(text)
-		cmd_chr = cmd_chr.lower()
+	for token in tokenize_mml(text):
+		cmd_chr = token.command
 		if cmd_chr == "t":
-			state["tempo"], text = p_next_number(text, 120)
-			cmd["name"] = "set_tempo"
-			cmd["tempo"] = state["tempo"]
-			cmd["length"] = 0
-			cmds.append(cmd)
+			state["tempo"] = mml_number(token, 120)
+			cmds.append(IrCommand("set_tempo", tempo=state["tempo"], length=0))
 		elif cmd_chr == "l":
-			state["note_length"], text = p_next_length(text, 16)
+			state["note_length"] = mml_length(token, 16)
 		elif cmd_chr == "v":
-			state["volume"], text = p_next_number(text, 8)
+			state["volume"] = mml_number(token, 8)
 		elif cmd_chr == "o":
-			state["octave"], text = p_next_number(text, 4)
+			state["octave"] = mml_number(token, 4)
 		elif cmd_chr == "<":
 			if state["octave"] > 1:
 				state["octave"] -= 1
@@ -119,113 +153,105 @@ def _parse_mml_to_single_ir(text, quirk):
 			if state["octave"] < 8:
 				state["octave"] += 1
 		elif cmd_chr in cmd_chr_notes:
-			cmd["name"] = "note"
-			cmd["volume"] = state["volume"]
-			cmd["octave"] = state["octave"]
-			cmd["note"] = cmd_chr_notes[cmd_chr]
-			if text[0:1] in cmd_chr_note_modifiers:
-				cmd["note"] += cmd_chr_note_modifiers[text[0:1]]
-				if cmd["note"] < 0:
-					cmd["note"] += 12
-				if cmd["note"] >= 12:
-					cmd["note"] -= 12
-				text = text[1:]
-			cmd["tempo"] = state["tempo"]
-			cmd["length"], text = p_next_length(text, state["note_length"])
+			note = cmd_chr_notes[cmd_chr]
+			if token.modifier in cmd_chr_note_modifiers:
+				note += cmd_chr_note_modifiers[token.modifier]
+				if note < 0:
+					note += 12
+				if note >= 12:
+					note -= 12
+			length = mml_length(token, state["note_length"])
 			if state["tie"] and (
-				(cmds[-1]["name"] == "note")
-				and (cmds[-1]["volume"] == cmd["volume"])
-				and (cmds[-1]["octave"] == cmd["octave"])
-				and (cmds[-1]["note"] == cmd["note"])
+				(cmds[-1].name == "note")
+				and (cmds[-1].volume == state["volume"])
+				and (cmds[-1].octave == state["octave"])
+				and (cmds[-1].note == note)
 			):
-				cmds[-1]["length"] += cmd["length"]
+				cmds[-1].length += length
 			else:
-				if (cmd["volume"] < MIN_VOLUME):
-					cmd["name"] = "pause"
-				cmds.append(cmd)
+				name = "pause" if (state["volume"] < MIN_VOLUME) else "note"
+				cmds.append(IrCommand(name, state["volume"], state["octave"], note, state["tempo"], length))
 			state["tie"] = False
 		elif cmd_chr == "&":
 			state["tie"] = True
 		elif (cmd_chr == "r") or (cmd_chr == "p"):
-			cmd["name"] = "pause"
-			cmd["volume"] = state["volume"]
-			cmd["tempo"] = state["tempo"]
-			cmd["length"], text = p_next_length(text, state["note_length"])
+			length = mml_length(token, state["note_length"])
 			# pauses make no sound, so ignore tie
-			if state["tie"] and (len(cmds) > 0) and (cmds[-1]["name"] == "pause"):
-				cmds[-1]["length"] += cmd["length"]
+			if state["tie"] and (len(cmds) > 0) and (cmds[-1].name == "pause"):
+				cmds[-1].length += length
 			else:
-				cmds.append(cmd)
+				cmds.append(IrCommand("pause", volume=state["volume"], tempo=state["tempo"], length=length))
 			state["tie"] = False
 		elif cmd_chr == "n":
-			midi_number, text = p_next_number(text, -1)
+			midi_number = mml_number(token, -1)
 			if midi_number >= 0:
 				midi_number = midi_number - 12
-				cmd["name"] = "note"
-				cmd["octave"] = int(midi_number / 12)
-				cmd["volume"] = state["volume"]
-				cmd["tempo"] = state["tempo"]
-				cmd["note"] = midi_number % 12
-				cmd["length"] = state["note_length"]
-				if (cmd["volume"] < MIN_VOLUME):
-					cmd["name"] = "pause"
-				cmds.append(cmd)
+				name = "pause" if (state["volume"] < MIN_VOLUME) else "note"
+				cmds.append(IrCommand(name, state["volume"], int(midi_number / 12), midi_number % 12, state["tempo"], state["note_length"]))
 		else:
-			print("warning: unknown command %s" % cmd_chr)
-	total_length = sum(map(lambda x: x["length"], cmds))
-	print("total length (channel): %d" % total_length, file=sys.stderr)
+			log("warning: unknown command %s" % cmd_chr)
+	total_length = sum(map(lambda x: x.length, cmds))
+	log("total length (channel): %d" % total_length, file=sys.stderr)
 	return cmds
 
-def join_multi_ir(multi_ir):
-	multi_ir = copy.deepcopy(multi_ir)
+def join_multi_ir(multi_ir, log=print):
+	# k-way merge over per-track cursors. The heap holds [remaining length,
+	# track] for the command under each cursor; as every track loses the same
+	# block length per block, subtracting it in place keeps the heap ordered
+	# and the lengths bit-identical to subtracting them one block at a time.
 	ir = []
 	tempo = 120
 	total_length = 0
-	while len(multi_ir) > 0:
+	cursors = [0] * len(multi_ir)
+	heap = []
+	for track, ir_part in enumerate(multi_ir):
+		if len(ir_part) > 0:
+			heap.append([ir_part[0].length, track])
+	heapq.heapify(heap)
+	active = sorted(entry[1] for entry in heap)
+	while len(heap) > 0:
 		# remove all empty blocks
-		for ir_part in multi_ir:
-			if (len(ir_part) > 0) and ("length" in ir_part[0]) and (ir_part[0]["length"] <= 0):
-				ir_part.pop(0)
+		advanced = []
+		while (len(heap) > 0) and (heap[0][0] <= 0):
+			track = heapq.heappop(heap)[1]
+			cursors[track] += 1
+			advanced.append(track)
 		# handle set_tempo
-		for ir_part in multi_ir:
-			while (len(ir_part) > 0) and (ir_part[0]["name"] == "set_tempo"):
-				tempo = ir_part[0]["tempo"]
-				ir_part.pop(0)
-		# remove all empty lists
-		multi_ir = list(filter(lambda x: len(x) > 0, multi_ir))
-		if len(multi_ir) > 0:
+		for track in sorted(advanced):
+			ir_part = multi_ir[track]
+			while (cursors[track] < len(ir_part)) and (ir_part[cursors[track]].name == "set_tempo"):
+				tempo = ir_part[cursors[track]].tempo
+				cursors[track] += 1
+			if cursors[track] < len(ir_part):
+				heapq.heappush(heap, [ir_part[cursors[track]].length, track])
+			else:
+				# remove all empty lists
+				active.remove(track)
+		if len(heap) > 0:
 			# let's add a new block!
-			block_len = min(map(lambda x: x[0]["length"], multi_ir))
+			block_len = heap[0][0]
 			# create block
-			joined_ir = {
-				"length": block_len,
-				"tempo": tempo,
-				"notes": []
-			}
+			notes = [multi_ir[track][cursors[track]] for track in active]
 			has_note = False
-			for ir_part in multi_ir:
-				note = copy.deepcopy(ir_part[0])
-				if note["name"] == "note":
+			for note in notes:
+				if note.name == "note":
 					has_note = True
-				del note["length"]
-				del note["tempo"]
-				joined_ir["notes"].append(note)
 			# cleanup 1: remove doubled-up pauses and unnecessary pauses
 			if has_note:
-				joined_ir["notes"] = list(filter(lambda x: x["name"] == "note", joined_ir["notes"]))
+				notes = list(filter(lambda x: x.name == "note", notes))
 			else:
-				joined_ir["notes"] = joined_ir["notes"][0:1]
+				notes = notes[0:1]
 			# cleanup 2: remove doubled notes
-			if len(joined_ir["notes"]) > 1:
-				old_notes = joined_ir["notes"]
+			if len(notes) > 1:
+				old_notes = notes
 				note_keys = {}
-				joined_ir["notes"] = []
+				notes = []
 				# find min/max note key
 				note_keys_allowed = {}
 				min_note_key = 1000
 				max_note_key = -1000
 				for i in old_notes:
-					note_key = i["octave"] * 16 + i["note"]
+					note_key = i.octave * 16 + i.note
 					if min_note_key > note_key:
 						min_note_key = note_key
 					if max_note_key < note_key:
@@ -233,32 +259,33 @@ def join_multi_ir(multi_ir):
 				note_keys_allowed[min_note_key] = True
 				note_keys_allowed[max_note_key] = True
 				for i in old_notes:
-					note_key = i["octave"] * 16 + i["note"]
+					note_key = i.octave * 16 + i.note
 					if note_key not in note_keys:
 						if (len(note_keys_allowed) <= 0) or (note_key in note_keys_allowed):
-							joined_ir["notes"].append(i)
+							notes.append(i)
 							note_keys[note_key] = True
+			joined_ir = IrBlock(block_len, tempo, notes)
 			ir.append(joined_ir)
 			total_length += block_len
 			# subtract lengths
-			for ir_part in multi_ir:
-				ir_part[0]["length"] -= block_len
-	print("total length (joined): %d" % total_length, file=sys.stderr)
+			for entry in heap:
+				entry[0] -= block_len
+	log("total length (joined): %d" % total_length, file=sys.stderr)
 	return ir
 
-def parse_mml_to_multi_ir(text, quirk=DEFAULT_MML_QUIRK):
+def parse_mml_to_multi_ir(text, quirk=DEFAULT_MML_QUIRK, log=print):
 	text = text.strip()
 	# if MML@ is found, clean up
 	if text.startswith("MML@"):
 		text = text[4:(text.rindex(";") or len(text))]
 	# split text into tracks
-	return list(map(lambda x: _parse_mml_to_single_ir(x, quirk), text.split(",")))
+	return list(map(lambda x: _parse_mml_to_single_ir(x, quirk, log), text.split(",")))
 
 def zzt_append_new_line(state):
 	text = state["text"]
 	s = "#play "
-	ticks_per_cycle = ZZT_OBJECT_CYCLE * 2
-	while (state["ticks"] >= ticks_per_cycle) and ((len(s) * 2) < ZZT_LINE_LENGTH):
+	ticks_per_cycle = state["object_cycle"] * 2
+	while (state["ticks"] >= ticks_per_cycle) and ((len(s) * 2) < state["line_length"]):
 		s = "/i" + s
 		state["ticks"] -= ticks_per_cycle
 	text.append(s)
@@ -271,13 +298,13 @@ def zzt_append_play(state, cmd, ticks):
 		text.append("#play ")
 	text[-1] += cmd
 	state["ticks"] += ticks
-	if ((len(text[-1]) + len(cmd)) >= ZZT_LINE_LENGTH):
+	if ((len(text[-1]) + len(cmd)) >= state["line_length"]):
 		zzt_append_new_line(state)
 
 def zzt_adjust_octave(state, note):
 	z_cmd = ""
-	if "octave" in note:
-		z_note_octave = note["octave"] - 1
+	if note.octave is not None:
+		z_note_octave = note.octave - 1
 		if z_note_octave < 1:
 			z_note_octave = 1
 		if z_note_octave > 6:
@@ -290,8 +317,140 @@ def zzt_adjust_octave(state, note):
 			state["octave"] -= 1
 	return z_cmd
 
-def parse_joined_ir_to_zzt(ir):
+zzt_lengths = sorted(zzt_note_lengths)
+
+# costs are in bytes * ZZT_COST_SCALE + segments, so that among encodings of
+# the same size the one with fewer re-struck notes wins
+ZZT_COST_SCALE = 1024
+ZZT_COST_INFINITE = float("inf")
+
+@functools.lru_cache(maxsize=None)
+def zzt_split_length(length, note_cost):
+	# Cheapest exact split of a note of `length` ZZT ticks into ZZT note
+	# lengths, a tie being written as the same note again. Returns a table
+	# indexed by [entry length index][exit length index] of (cost, segments).
+	result = []
+	for entry in range(len(zzt_lengths)):
+		best = [[ZZT_COST_INFINITE] * len(zzt_lengths) for i in range(length + 1)]
+		parent = [[None] * len(zzt_lengths) for i in range(length + 1)]
+		best[length][entry] = 0
+		for remaining in range(length, 0, -1):
+			for current in range(len(zzt_lengths)):
+				cost = best[remaining][current]
+				if cost == ZZT_COST_INFINITE:
+					continue
+				for next_idx, next_length in enumerate(zzt_lengths):
+					if next_length > remaining:
+						break
+					next_cost = note_cost if next_idx == current else note_cost + len(zzt_note_lengths[next_length])
+					next_cost = cost + next_cost * ZZT_COST_SCALE + 1
+					if next_cost < best[remaining - next_length][next_idx]:
+						best[remaining - next_length][next_idx] = next_cost
+						parent[remaining - next_length][next_idx] = current
+		row = []
+		for exit_idx in range(len(zzt_lengths)):
+			segments = []
+			remaining, current = 0, exit_idx
+			if best[0][exit_idx] != ZZT_COST_INFINITE:
+				while remaining < length:
+					segments.append(zzt_lengths[current])
+					remaining, current = remaining + zzt_lengths[current], parent[remaining][current]
+				segments.reverse()
+			row.append((best[0][exit_idx], segments))
+		result.append(row)
+	return result
+
+def zzt_arpeggio_tick_cost(notes):
+	# estimated bytes per 1/32 note of an arpeggio: note name plus octave change
+	notes = [n for n in notes if n.name == "note"]
+	if len(notes) == 0:
+		return 0
+	cost = 0
+	for i in range(len(notes)):
+		cost += len(zzt_note_notes[notes[i].note]) + abs(notes[i].octave - notes[i - 1].octave)
+	return cost / len(notes)
+
+def zzt_plan_lengths(ir):
+	# Dynamic programming over (current note length, carried ticks) across all
+	# blocks. Every single-note block is either played for its exact length,
+	# or rounded down to a ZZT note length with the rest carried into the next
+	# block, as the default converter does; both may be split into tied
+	# notes. Returns the planned segment lengths per block ([ticks] for
+	# arpeggios, None for blocks which play nothing) of the smallest output.
+	# Octave changes are fixed by the notes themselves, and line breaks
+	# (which reset the length) are not modelled.
+	states = {(0, 0): 0}
+	choices = []
+	for note_group in ir:
+		base_length = int(note_group.length / 2.0)
+		note = note_group.notes[0] if len(note_group.notes) > 0 else None
+		new_states = {}
+		back = {}
+		if len(note_group.notes) > 1:
+			tick_cost = zzt_arpeggio_tick_cost(note_group.notes)
+		elif (note is not None) and (note.name in ("note", "pause")):
+			note_cost = 1 if note.name == "pause" else len(zzt_note_notes[note.note])
+		for (entry, length_diff), cost in states.items():
+			z_note_length = base_length + length_diff
+			extra_diff = 0
+			if z_note_length < 1:
+				extra_diff = 1 - z_note_length
+				z_note_length = 1
+			if len(note_group.notes) > 1:
+				# arpeggios are always played as 1/32 notes
+				key = (0, extra_diff)
+				new_cost = cost + ((0 if entry == 0 else len(zzt_note_lengths[1])) + z_note_length * tick_cost) * ZZT_COST_SCALE
+				if new_cost < new_states.get(key, ZZT_COST_INFINITE):
+					new_states[key], back[key] = new_cost, ((entry, length_diff), [z_note_length])
+			elif (note is not None) and (note.name in ("note", "pause")):
+				rounded_length = max(l for l in zzt_lengths if l <= z_note_length)
+				for target in set((z_note_length, rounded_length)):
+					carry = z_note_length - target + extra_diff
+					for exit_idx, (split_cost, segments) in enumerate(zzt_split_length(target, note_cost)[entry]):
+						key = (exit_idx, carry)
+						# on equal size, prefer exact timing
+						new_cost = cost + split_cost + carry
+						if new_cost < new_states.get(key, ZZT_COST_INFINITE):
+							new_states[key], back[key] = new_cost, ((entry, length_diff), segments)
+			else:
+				key = (entry, length_diff)
+				if cost < new_states.get(key, ZZT_COST_INFINITE):
+					new_states[key], back[key] = cost, ((entry, length_diff), None)
+		states = new_states
+		choices.append(back)
+	# walk back from the cheapest final state
+	plan = [None] * len(choices)
+	current = min(states, key=lambda k: states[k])
+	for i in range(len(choices) - 1, -1, -1):
+		current, plan[i] = choices[i][current]
+	return plan
+
+def iter_joined_ir_to_zzt(ir, line_length=ZZT_LINE_LENGTH, object_cycle=ZZT_OBJECT_CYCLE, log=print, optimize=False):
+	# Yields #play lines as soon as they are complete. With optimize, note
+	# lengths are planned by zzt_plan_lengths instead of being rounded down.
+	# The plan does not model line breaks, so it can come out larger than
+	# the default encoding; both are then built and the smaller one yielded.
+	if not optimize:
+		yield from _iter_zzt_lines(ir, line_length, object_cycle, log)
+		return
+	lines = list(_iter_zzt_lines(ir, line_length, object_cycle, log, zzt_plan_lengths(ir)))
+	greedy_lines = list(_iter_zzt_lines(ir, line_length, object_cycle, _no_log))
+	size = len("\n".join(lines))
+	greedy_size = len("\n".join(greedy_lines))
+	if (greedy_size, len(greedy_lines)) <= (size, len(lines)):
+		lines = greedy_lines
+		size = greedy_size
+	log("size: %d bytes, %d lines (greedy: %d bytes, %d lines; saved %d bytes, %d lines)" % (
+		size, len(lines), greedy_size, len(greedy_lines), greedy_size - size, len(greedy_lines) - len(lines)
+	), file=sys.stderr)
+	yield from lines
+
+def _iter_zzt_lines(ir, line_length, object_cycle, log, plan=None):
+	# The #play encoder; plan is the output of zzt_plan_lengths, or None to
+	# round each note down to a ZZT length.
 	state = {
+		"line_length": line_length,
+		"object_cycle": object_cycle,
 		"text": [],
 		"octave": 3,
 		"length": 1,
@@ -300,34 +459,51 @@ def parse_joined_ir_to_zzt(ir):
 		"ticks": 0
 	}
 	duration = 0
-	for note_group in ir:
+	for note_idx, note_group in enumerate(ir):
 		# note["length"] = 2 - 1/32, 64 - whole note
 		# zzt length = 1 - 1/32 32 - whole note
 		# 120 BPM = whole note
 		# all of this is HACKS
-		z_note_length = int(note_group["length"] / 2.0) + state["length_diff"]
+		z_note_length = int(note_group.length / 2.0) + state["length_diff"]
 		state["length_diff"] = 0
 		if z_note_length < 1:
 			state["length_diff"] += 1 - z_note_length
 			z_note_length = 1
-		if len(note_group["notes"]) > 1:
+		if len(note_group.notes) > 1:
+			if plan is not None:
+				z_note_length = plan[note_idx][0]
 			# time to modulate up the wazoo
 			duration += z_note_length
 			while z_note_length > 0:
-				state["modulate_counter"] = int(state["modulate_counter"] % len(note_group["notes"]))
+				state["modulate_counter"] = int(state["modulate_counter"] % len(note_group.notes))
 				#
-				note = note_group["notes"][state["modulate_counter"]]
-				if note["name"] == "note":
+				note = note_group.notes[state["modulate_counter"]]
+				if note.name == "note":
 					z_cmd = ""
 					if state["length"] != 1:
 						z_cmd += zzt_note_lengths[1]
 						state["length"] = 1
 					z_cmd += zzt_adjust_octave(state, note)
-					z_cmd += zzt_note_notes[note["note"]]
+					z_cmd += zzt_note_notes[note.note]
 					zzt_append_play(state, z_cmd, 1)
 					z_note_length -= 1
 				#
 				state["modulate_counter"] += 1
+		elif (plan is not None) and (plan[note_idx] is not None):
+			# planned lengths, tied notes played again
+			note = note_group.notes[0]
+			for z_note_length in plan[note_idx]:
+				z_cmd = ""
+				if state["length"] != z_note_length:
+					z_cmd += zzt_note_lengths[z_note_length]
+					state["length"] = z_note_length
+				if note.name == "pause":
+					z_cmd += "x"
+				else:
+					z_cmd += zzt_adjust_octave(state, note)
+					z_cmd += zzt_note_notes[note.note]
+				duration += z_note_length
+				zzt_append_play(state, z_cmd, z_note_length)
 		else:
 			# just the one
 			z_cmd = ""
@@ -338,37 +514,168 @@ def parse_joined_ir_to_zzt(ir):
 				z_cmd += zzt_note_lengths[z_note_length]
 				state["length"] = z_note_length
 			# note
-			note = note_group["notes"][0]
-			if note["name"] == "pause":
+			note = note_group.notes[0]
+			if note.name == "pause":
 				z_cmd += "x"
 				duration += z_note_length
 				zzt_append_play(state, z_cmd, z_note_length)
-			elif note["name"] == "note":
+			elif note.name == "note":
 				z_cmd += zzt_adjust_octave(state, note)
-				z_cmd += zzt_note_notes[note["note"]]
+				z_cmd += zzt_note_notes[note.note]
 				duration += z_note_length
 				zzt_append_play(state, z_cmd, z_note_length)
 			else:
-				print("warning: unknown notecmd %s" % note["name"], file=sys.stderr)
-	print("duration: %.2f seconds" % (duration / 18.2), file=sys.stderr)
-	return "\n".join(state["text"])
+				log("warning: unknown notecmd %s" % note.name, file=sys.stderr)
+		# every line but the last one being appended to is done
+		if len(state["text"]) > 1:
+			lines = state["text"][:-1]
+			del state["text"][:-1]
+			yield from lines
+	log("duration: %.2f seconds" % (duration / 18.2), file=sys.stderr)
+	yield from state["text"]
+
+def parse_joined_ir_to_zzt(ir, line_length=ZZT_LINE_LENGTH, object_cycle=ZZT_OBJECT_CYCLE, log=print, optimize=False):
+	return "\n".join(iter_joined_ir_to_zzt(ir, line_length, object_cycle, log, optimize))
+
+def iter_convert(text, quirk=DEFAULT_MML_QUIRK, line_length=ZZT_LINE_LENGTH, object_cycle=ZZT_OBJECT_CYCLE, log=None, optimize=False):
+	# Converts MML text to ZZT code, yielding #play lines as they are
+	# generated. Messages are passed to log (a print-like callable), if given.
+	if log is None:
+		log = _no_log
+	multi_ir = parse_mml_to_multi_ir(text, quirk, log)
+	joined_ir = join_multi_ir(multi_ir, log)
+	yield from iter_joined_ir_to_zzt(joined_ir, line_length, object_cycle, log, optimize)
+
+def convert(text, quirk=DEFAULT_MML_QUIRK, line_length=ZZT_LINE_LENGTH, object_cycle=ZZT_OBJECT_CYCLE, log=None, optimize=False):
+	return "\n".join(iter_convert(text, quirk, line_length, object_cycle, log, optimize))
+
+def convert_file(filename, quirk, line_length, object_cycle, optimize=False):
+	# Batch worker: returns the ZZT code and the messages printed while converting.
+	with open(filename, "r") as f:
+		mml_text = f.read()
+	messages = io.StringIO()
+	def log(*args, **kwargs):
+		kwargs["file"] = messages
+		print(*args, **kwargs)
+	text = convert(mml_text, quirk, line_length, object_cycle, log, optimize)
+	return text, messages.getvalue()
+
+def cache_key(mml_text, quirk, line_length, object_cycle, optimize=False):
+	# the converter's own source is part of the key, so cached output never
+	# outlives a change to the conversion
+	h = hashlib.sha1()
+	with open(__file__, "rb") as f:
+		h.update(f.read())
+	for part in (mml_text, quirk, str(line_length), str(object_cycle), str(optimize)):
+		h.update(part.encode("utf-8"))
+		h.update(b"\0")
+	return h.hexdigest()
+
+def find_mml_files(paths):
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				dirs.sort()
+				for name in sorted(files):
+					if name.lower().endswith(".mml"):
+						yield os.path.join(root, name)
+		else:
+			yield path
+
+def convert_batch(filenames, output_dir, quirk, line_length, object_cycle, jobs=None, cache_dir=None, optimize=False):
+	# Converts every file in a process pool, writing <name>.txt next to the
+	# input or into output_dir. In output_dir, each file keeps its path
+	# relative to the directory common to all inputs, so files with the same
+	# name in different directories do not overwrite each other. Songs found
+	# in cache_dir are not reconverted. A file which fails to convert is
+	# reported and skipped; returns the number of such files.
+	if output_dir is not None:
+		os.makedirs(output_dir, exist_ok=True)
+		if len(filenames) > 0:
+			common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in filenames])
+	if cache_dir is not None:
+		os.makedirs(cache_dir, exist_ok=True)
+	pending = []
+	failed = 0
+	for filename in filenames:
+		if output_dir is None:
+			out_filename = filename + ".txt"
+		else:
+			out_filename = os.path.join(output_dir, os.path.relpath(os.path.abspath(filename), common_dir) + ".txt")
+			os.makedirs(os.path.dirname(out_filename), exist_ok=True)
+		cache_filename = None
+		if cache_dir is not None:
+			try:
+				with open(filename, "r") as f:
+					key = cache_key(f.read(), quirk, line_length, object_cycle, optimize)
+			except (OSError, ValueError) as e:
+				print("%s: error: %s" % (filename, e), file=sys.stderr)
+				failed += 1
+				continue
+			cache_filename = os.path.join(cache_dir, key + ".txt")
+			if os.path.exists(cache_filename):
+				with open(cache_filename, "r") as f:
+					text = f.read()
+				with open(out_filename, "w") as f:
+					f.write(text)
+				print("%s: cached" % filename, file=sys.stderr)
+				continue
+		pending.append((filename, out_filename, cache_filename))
+	with ProcessPoolExecutor(jobs) as executor:
+		futures = [executor.submit(convert_file, filename, quirk, line_length, object_cycle, optimize) for filename, _, _ in pending]
+		for (filename, out_filename, cache_filename), future in zip(pending, futures):
+			try:
+				text, messages = future.result()
+			except Exception as e:
+				print("%s: error: %s" % (filename, str(e) or type(e).__name__), file=sys.stderr)
+				failed += 1
+				continue
+			print("%s:" % filename, file=sys.stderr)
+			sys.stderr.write(messages)
+			with open(out_filename, "w") as f:
+				f.write(text + "\n")
+			if cache_filename is not None:
+				with open(cache_filename + ".tmp", "w") as f:
+					f.write(text + "\n")
+				os.replace(cache_filename + ".tmp", cache_filename)
+	return failed
 
-parser = argparse.ArgumentParser(description="Convert MML scripts to ZZT sound code.")
-parser.add_argument("-q", "--quirk", default=DEFAULT_MML_QUIRK)
-parser.add_argument("-l", "--line-length", type=int, default=ZZT_LINE_LENGTH)
-parser.add_argument("-c", "--object-cycle", type=int, default=ZZT_OBJECT_CYCLE)
-parser.add_argument("file")
-args = parser.parse_args()
+def main():
+	parser = argparse.ArgumentParser(description="Convert MML scripts to ZZT sound code.")
+	parser.add_argument("-q", "--quirk", default=DEFAULT_MML_QUIRK)
+	parser.add_argument("-l", "--line-length", type=int, default=ZZT_LINE_LENGTH)
+	parser.add_argument("-c", "--object-cycle", type=int, default=ZZT_OBJECT_CYCLE)
+	parser.add_argument("-O", "--optimize", action="store_true",
+		help="choose note lengths for the smallest output, splitting notes into tied lengths where needed")
+	parser.add_argument("-o", "--output-dir", default=None,
+		help="batch mode: write <file>.txt for every input into this directory")
+	parser.add_argument("-j", "--jobs", type=int, default=None,
+		help="batch mode: number of worker processes")
+	parser.add_argument("--cache", default=None, metavar="DIR",
+		help="batch mode: keep converted songs in DIR and skip unchanged ones")
+	parser.add_argument("file", nargs="+",
+		help="MML file; several files or directories convert in batch mode")
+	args = parser.parse_args()
 
-ZZT_LINE_LENGTH = args.line_length
-ZZT_OBJECT_CYCLE = args.object_cycle
+	if (len(args.file) > 1) or os.path.isdir(args.file[0]) or (args.output_dir is not None) or (args.cache is not None):
+		failed = convert_batch(list(find_mml_files(args.file)), args.output_dir, args.quirk,
+			args.line_length, args.object_cycle, args.jobs, args.cache, args.optimize)
+		if failed > 0:
+			print("%d of the files failed to convert" % failed, file=sys.stderr)
+			sys.exit(1)
+		return
 
-f = open(args.file, "r")
-mml_text = f.read()
-f.close()
+	f = open(args.file[0], "r")
+	mml_text = f.read()
+	f.close()
 
-multi_ir = parse_mml_to_multi_ir(mml_text, args.quirk)
-joined_ir = join_multi_ir(multi_ir)
-text = parse_joined_ir_to_zzt(joined_ir)
+	# stream lines out as they are generated
+	has_lines = False
+	for line in iter_convert(mml_text, args.quirk, args.line_length, args.object_cycle, print, args.optimize):
+		print(line)
+		has_lines = True
+	if not has_lines:
+		print("")
 
-print(text)
+if __name__ == "__main__":
+	main()
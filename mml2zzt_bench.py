@@ -0,0 +1,151 @@
+# Copyright (c) 2026 Adrian Siekierka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#!/usr/bin/env python3
+# Benchmark and regression check for the three mml2zzt stages.
+#
+# Synthetic songs are generated from fixed seeds, each stage is timed and its
+# peak memory recorded separately, and the generated ZZT code is compared
+# byte for byte against the golden files in mml2zzt_golden/ (regenerate them
+# with --update after an intended output change).
+import argparse, os, random, sys, time, tracemalloc
+
+import mml2zzt
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mml2zzt_golden")
+
+# name: (seed, tracks, notes per track, tie density, chord density)
+CASES = {
+	"solo": (1, 1, 400, 0.0, 0.0),
+	"solo_ties": (2, 1, 400, 0.4, 0.0),
+	"duet": (3, 2, 400, 0.1, 0.3),
+	"quartet_chords": (4, 4, 300, 0.1, 0.8),
+	"sextet_long": (5, 6, 1200, 0.2, 0.5),
+}
+
+NOTE_LENGTHS = ["", "", "", "1", "2", "4", "8", "16", "32", "4.", "8.", "3", "6", "12", "24"]
+
+def no_log(*args, **kwargs):
+	pass
+
+def generate_mml(seed, tracks, notes, tie_density, chord_density):
+	# chord_density is the chance of a track sounding a note rather than
+	# resting, so higher values give more simultaneous (arpeggiated) notes
+	rnd = random.Random(seed)
+	parts = []
+	for track in range(tracks):
+		out = ["t%d l8 o%d v%d" % (rnd.choice([90, 120, 150]), rnd.randrange(3, 6), rnd.randrange(8, 16))]
+		for i in range(notes):
+			if (track > 0) and (rnd.random() >= chord_density):
+				out.append("r" + rnd.choice(NOTE_LENGTHS))
+				continue
+			k = rnd.random()
+			if k < 0.05:
+				out.append(rnd.choice(["<", ">"]))
+			elif k < 0.08:
+				out.append("l" + rnd.choice(["4", "8", "16"]))
+			elif k < 0.1:
+				out.append("n%d" % rnd.randrange(36, 84))
+			elif k < 0.11:
+				out.append("t%d" % rnd.choice([90, 120, 150]))
+			note = rnd.choice("cdefgab") + rnd.choice(["", "", "", "+", "-"]) + rnd.choice(NOTE_LENGTHS)
+			if rnd.random() < tie_density:
+				note += "&" + note
+			out.append(note)
+		parts.append("".join(out))
+	return "MML@" + ",".join(parts) + ";"
+
+def run_stages(mml_text, optimize):
+	multi_ir = mml2zzt.parse_mml_to_multi_ir(mml_text, mml2zzt.DEFAULT_MML_QUIRK, no_log)
+	joined_ir = mml2zzt.join_multi_ir(multi_ir, no_log)
+	text = mml2zzt.parse_joined_ir_to_zzt(joined_ir, log=no_log, optimize=optimize)
+	return multi_ir, joined_ir, text
+
+def measure(mml_text, repeat, optimize):
+	# returns ({stage: best time}, {stage: peak bytes}, output)
+	stages = [
+		("parse", lambda: mml2zzt.parse_mml_to_multi_ir(mml_text, mml2zzt.DEFAULT_MML_QUIRK, no_log)),
+		("join", lambda: mml2zzt.join_multi_ir(multi_ir, no_log)),
+		("zzt", lambda: mml2zzt.parse_joined_ir_to_zzt(joined_ir, log=no_log, optimize=optimize)),
+	]
+	multi_ir, joined_ir, text = run_stages(mml_text, optimize)
+	times = {}
+	peaks = {}
+	for name, stage in stages:
+		best = None
+		for i in range(repeat):
+			start = time.perf_counter()
+			stage()
+			elapsed = time.perf_counter() - start
+			if (best is None) or (elapsed < best):
+				best = elapsed
+		times[name] = best
+		tracemalloc.start()
+		stage()
+		peaks[name] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	return times, peaks, text
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark and regression check for mml2zzt.")
+	parser.add_argument("-u", "--update", action="store_true",
+		help="write the current output as the new golden files")
+	parser.add_argument("-r", "--repeat", type=int, default=3,
+		help="time each stage this many times and keep the best")
+	parser.add_argument("-s", "--scale", type=int, default=1,
+		help="multiply song lengths (golden files are only compared at scale 1)")
+	parser.add_argument("case", nargs="*",
+		help="cases to run (default: all of %s)" % ", ".join(CASES))
+	args = parser.parse_args()
+
+	failed = False
+	print("%-16s %-4s %7s %9s %9s %9s %10s %10s %10s  %s" % (
+		"case", "opt", "notes", "parse", "join", "zzt", "parse mem", "join mem", "zzt mem", "golden"))
+	for name in args.case or CASES:
+		seed, tracks, notes, tie_density, chord_density = CASES[name]
+		mml_text = generate_mml(seed, tracks, notes * args.scale, tie_density, chord_density)
+		for optimize in (False, True):
+			times, peaks, text = measure(mml_text, args.repeat, optimize)
+			text += "\n"
+			golden_filename = os.path.join(GOLDEN_DIR, name + (".opt" if optimize else "") + ".txt")
+			if args.scale != 1:
+				status = "-"
+			elif args.update:
+				os.makedirs(GOLDEN_DIR, exist_ok=True)
+				with open(golden_filename, "w", newline="\n") as f:
+					f.write(text)
+				status = "updated"
+			elif not os.path.exists(golden_filename):
+				status = "missing"
+				failed = True
+			else:
+				with open(golden_filename, "r", newline="\n") as f:
+					status = "ok" if f.read() == text else "DIFFERENT"
+				if status != "ok":
+					failed = True
+			print("%-16s %-4s %7d %8.3fs %8.3fs %8.3fs %9.1fM %9.1fM %9.1fM  %s" % (
+				name, "yes" if optimize else "no", tracks * notes * args.scale,
+				times["parse"], times["join"], times["zzt"],
+				peaks["parse"] / 1e6, peaks["join"] / 1e6, peaks["zzt"] / 1e6, status))
+	if failed:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
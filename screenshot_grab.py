@@ -18,33 +18,218 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-# Usage: screenshot_grab.py [world]
+# Usage: screenshot_grab.py [-j JOBS] [-f] [--font FONT] [world]
 
 #!/usr/bin/env python3
-import zookeeper
-import math, os, re, sys
+import boardwalk
+import argparse, hashlib, io, json, math, os, re, shutil, sys
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import zookeeper
+except ImportError:
+    zookeeper = None
 
 rule_filename = "[^\w\-_\. ]"
 
+MANIFEST_FILENAME = ".screenshots.json"
+MANIFEST_VERSION = 1
+
+def render_options(font_filename):
+    # anything that changes how a board is rendered, for the manifest keys;
+    # bump the version when the output of render_board() changes
+    if font_filename is None:
+        return "1;title_screen=True,False;png;zookeeper=%s" % getattr(zookeeper, "__version__", "?")
+    with open(font_filename, "rb") as f:
+        return "1;title_screen=True,False;png;builtin;font=%s" % hashlib.sha256(f.read()).hexdigest()
+
+# per-process state: each worker loads the world (and font) once
+_world = None
+_renderer = None
+_buffers = None
+_encoder = None
+
+def init_worker(filename, font_filename=None):
+    global _world, _renderer, _buffers, _encoder
+    if font_filename is None:
+        _world = zookeeper.Zookeeper(filename)
+    else:
+        import numpy as np
+        import zzt_render
+        _world = boardwalk.WorldIndex(filename)
+        _renderer = zzt_render.BoardRenderer(zzt_render.load_font(font_filename))
+        _buffers = [np.empty(_renderer.shape, dtype=np.uint8) for i in range(2)]
+    _encoder = ThreadPoolExecutor(max_workers=1)
+
+def encode_png(img):
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+def render_board(idx):
+    # the title screen render is PNG-encoded on a helper thread while the
+    # player render is drawn
+    if _renderer is not None:
+        b = _world.decode_board(idx)
+        # the two buffers are reused by the next board, once both are encoded
+        png_tsy = _encoder.submit(encode_png, Image.fromarray(_renderer.render(b, True, _buffers[0])))
+        png_tsn = encode_png(Image.fromarray(_renderer.render(b, False, _buffers[1])))
+        return b.title, png_tsy.result(), png_tsn
+    b = _world.boards[idx]
+    png_tsy = _encoder.submit(encode_png, b.render(title_screen=True))
+    png_tsn = encode_png(b.render(title_screen=False))
+    return b.title, png_tsy.result(), png_tsn
+
+def iter_rendered_boards(filename, indices, jobs, font_filename=None):
+    if jobs <= 1:
+        init_worker(filename, font_filename)
+        for idx in indices:
+            yield render_board(idx)
+    else:
+        chunksize = max(1, min(8, len(indices) // (jobs * 4)))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(filename, font_filename)) as executor:
+            yield from executor.map(render_board, indices, chunksize=chunksize)
+
+def board_keys(index, board_count, options):
+    # Hashes each raw board record (title, tiles, info and stats) together
+    # with the render options. Boards missing from a truncated world get
+    # None and are always rendered.
+    keys = [None] * board_count
+    for entry in index.boards[:board_count]:
+        if entry.next_position > len(index.data):
+            continue
+        h = hashlib.sha256(options.encode("utf-8"))
+        h.update(index.data[entry.position:entry.next_position])
+        keys[entry.id] = h.hexdigest()
+    return keys
+
+def load_manifest(dir):
+    filename = os.path.join(dir, MANIFEST_FILENAME)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["boards"]
+
+def save_manifest(dir, boards):
+    filename = os.path.join(dir, MANIFEST_FILENAME)
+    with open(filename + ".tmp", "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "boards": boards}, f, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+class ImageStore:
+    # Content-addressed PNG store in <dir>/.images; the named screenshots
+    # are hard links to it (or copies, where links are not supported), so
+    # identical images are kept once.
+    def __init__(self, dir):
+        self.dir = os.path.join(dir, ".images")
+        if not os.path.exists(self.dir):
+            os.mkdir(self.dir)
+
+    def path(self, digest):
+        return os.path.join(self.dir, digest + ".png")
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, png):
+        digest = hashlib.sha256(png).hexdigest()
+        if not self.has(digest):
+            with open(self.path(digest) + ".tmp", "wb") as fp:
+                fp.write(png)
+            os.replace(self.path(digest) + ".tmp", self.path(digest))
+        return digest
+
+    def place(self, filename, digest):
+        source = self.path(digest)
+        if os.path.exists(filename):
+            if os.path.samefile(filename, source):
+                return
+            os.unlink(filename)
+        try:
+            os.link(source, filename)
+        except OSError:
+            shutil.copyfile(source, filename)
+
+    def prune(self, digests):
+        for name in os.listdir(self.dir):
+            if os.path.splitext(name)[0] not in digests:
+                os.unlink(os.path.join(self.dir, name))
+
 def main():
-    f = sys.argv[-1]
+    parser = argparse.ArgumentParser(description="Take screenshots of all boards of a ZZT world.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="number of worker processes (default: CPU count)")
+    parser.add_argument("-f", "--force", action="store_true",
+        help="render all boards, ignoring the manifest of earlier runs")
+    parser.add_argument("--font", metavar="FILE",
+        help="render with the built-in renderer and this 8xN font (raw bitmap or 16x16 glyph image) instead of zookeeper")
+    parser.add_argument("world")
+    args = parser.parse_args()
+
+    f = args.world
     dir = os.path.splitext(os.path.basename(f))[0]
     if not os.path.exists(dir):
         os.mkdir(dir)
-    w = zookeeper.Zookeeper(f)
-    for idx in range(0, w.world.total_boards):
-        print("%d/%d" % (idx, w.world.total_boards))
-        b = w.boards[idx]
-        img_tsy = b.render(title_screen=True)
-        img_tsn = b.render(title_screen=False)
-        fn_tsy = os.path.join(dir, "%03dT %s.png" % (idx, re.sub(rule_filename, "_", b.title)))
-        fn_tsn = os.path.join(dir, "%03dP %s.png" % (idx, re.sub(rule_filename, "_", b.title)))
-        img_tsy.save(fn_tsy, "PNG")
-        img_tsn.save(fn_tsn, "PNG")
+    if (args.font is None) and (zookeeper is None):
+        parser.error("zookeeper is not installed; use --font to render with the built-in renderer")
+    # the board count and keys come from the index, so an unchanged world is
+    # never decoded; zookeeper renders every board the header counts
+    try:
+        with boardwalk.WorldIndex(f) as index:
+            board_count = len(index) if args.font is not None else index.board_count + 1
+            keys = board_keys(index, board_count, render_options(args.font))
+    except ValueError as e:
+        print("%s: error: %s" % (f, e), file=sys.stderr)
+        sys.exit(1)
+    store = ImageStore(dir)
+    old_manifest = load_manifest(dir)
 
-if __name__ == "__main__":
-    main()
+    # renders from earlier runs which are still in the store, by board key
+    rendered = {}
+    if not args.force:
+        for entry in old_manifest.values():
+            if (entry["key"] is not None) and store.has(entry["T_hash"]) and store.has(entry["P_hash"]):
+                rendered[entry["key"]] = entry
 
+    # render each changed board once, even if it appears several times
+    to_render = []
+    seen = set(rendered)
+    for idx, key in enumerate(keys):
+        if (key is None) or (key not in seen):
+            to_render.append(idx)
+            seen.add(key)
+    results = iter_rendered_boards(f, to_render, max(1, min(args.jobs, len(to_render))), args.font)
 
+    manifest = {}
+    for idx, key in enumerate(keys):
+        print("%d/%d" % (idx, board_count))
+        if (key is not None) and (key in rendered):
+            title = rendered[key]["title"]
+            digests = {v: rendered[key][v + "_hash"] for v in ("T", "P")}
+        else:
+            title, png_tsy, png_tsn = next(results)
+            digests = {"T": store.put(png_tsy), "P": store.put(png_tsn)}
+        entry = {"key": key, "title": title}
+        for v in ("T", "P"):
+            entry[v] = "%03d%s %s.png" % (idx, v, re.sub(rule_filename, "_", title))
+            entry[v + "_hash"] = digests[v]
+            store.place(os.path.join(dir, entry[v]), digests[v])
+        manifest["%03d" % idx] = entry
+        if key is not None:
+            rendered[key] = entry
 
+    # drop screenshots of boards which were renamed or removed since the last run
+    names = set(e[v] for e in manifest.values() for v in ("T", "P"))
+    for entry in old_manifest.values():
+        for v in ("T", "P"):
+            if (entry[v] not in names) and os.path.exists(os.path.join(dir, entry[v])):
+                os.unlink(os.path.join(dir, entry[v]))
+    store.prune(set(e[v + "_hash"] for e in manifest.values() for v in ("T", "P")))
+    save_manifest(dir, manifest)
+    print("%d/%d boards rendered" % (len(to_render), board_count))
 
+if __name__ == "__main__":
+    main()
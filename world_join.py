@@ -18,44 +18,222 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-# Usage: world_join.py [worlds...] [output world]
+# Usage: world_join.py [-j JOBS] [-d] [worlds...] [output world]
+#        world_join.py [-j JOBS] [-d] --append [worlds...] [existing world]
 
 #!/usr/bin/env python3
-import zookeeper
-import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from struct import pack, unpack_from
+import argparse, hashlib, os, sys
 
-def main():
-    worldMain = zookeeper.Zookeeper(sys.argv[1])
-
-    for i in range(2, len(sys.argv) - 1):
-        worldSub = zookeeper.Zookeeper(sys.argv[i])
-        boardOffsetMain = worldMain.world.total_boards
-        for idx in range(0, worldSub.world.total_boards):
-            boardSub: zookeeper.Board = worldSub.boards[idx]
-            # transpose board IDs
-            if boardSub.board_north > 0:
-                boardSub.board_north += boardOffsetMain
-            if boardSub.board_south > 0:
-                boardSub.board_south += boardOffsetMain
-            if boardSub.board_west > 0:
-                boardSub.board_west += boardOffsetMain
-            if boardSub.board_east > 0:
-                boardSub.board_east += boardOffsetMain
-            for statIdx in range(0, boardSub.stat_count):
-                stat: zookeeper.Stat = boardSub.stats[statIdx]
-                element: zookeeper.Element = boardSub.elements[(stat.x - 1 + ((stat.y - 1) * 60))]
-                # Passage
-                if element.id == 11:
-                    stat.param3 = stat.param3 + boardOffsetMain
-            # append
-            worldMain.boards.append(boardSub)
-        worldMain.world._total_boards += worldSub.world._total_boards
-
-    worldMain.save(sys.argv[-1])
+import boardwalk
 
-if __name__ == "__main__":
-    main()
+# offsets of the board_north/south/west/east bytes in the board info
+BOARD_INFO_EXITS = 2
+# offset of param3 in a stat
+STAT_P3 = 10
+MAX_BOARDS = 255
+MAX_BOARD_SIZE = 20000
+
+# A board record and the bytes to patch when its IDs are moved: exits and
+# passages are lists of (offset in the record, board ID). digest hashes the
+# record with those bytes zeroed.
+BoardPatch = namedtuple("BoardPatch", ["position", "length", "exits", "passages", "digest"])
+WorldScan = namedtuple("WorldScan", ["filename", "header", "boards", "end"])
+# remap[i] is the output ID of board i of the joined worlds, counted as if
+# nothing was dropped; dropped is the set of such IDs left out.
+JoinPlan = namedtuple("JoinPlan", ["remap", "dropped", "board_total", "saved"])
+
+def check_board_length(index, board_id, name="world"):
+    entry = index[board_id]
+    if entry.next_position > len(index.data):
+        raise ValueError("%s: board %d is truncated" % (name, entry.id))
+    if entry.length + 2 > MAX_BOARD_SIZE:
+        raise ValueError("%s: board %d is %d bytes, over the limit of %d" % (name, entry.id, entry.length + 2, MAX_BOARD_SIZE))
+    return BoardPatch(entry.position, entry.length + 2, [], [], None)
+
+def scan_board(index, board_id, name="world"):
+    entry = index[board_id]
+    check_board_length(index, board_id, name)
+    # the bytes to patch must lie inside the record
+    if (entry.rle_end is None) or (entry.rle_end + BOARD_INFO_EXITS + 4 > entry.next_position):
+        raise ValueError("%s: board %d is corrupt, its tiles run past its length" % (name, entry.id))
+    exits = []
+    for pos in range(entry.rle_end + BOARD_INFO_EXITS, entry.rle_end + BOARD_INFO_EXITS + 4):
+        if index.data[pos] > 0:
+            exits.append((pos - entry.position, index.data[pos]))
+    passages = []
+    stats = list(index.iter_stats(board_id))
+    for pos, stat, code in stats:
+        if pos + boardwalk.STAT_SIZE > entry.next_position:
+            raise ValueError("%s: board %d is corrupt, its stats run past its length" % (name, entry.id))
+    elements = index.elements_at(board_id, [(stat.x, stat.y) for pos, stat, code in stats])
+    for (pos, stat, code), element in zip(stats, elements):
+        if element == boardwalk.E_PASSAGE:
+            passages.append((pos + STAT_P3 - entry.position, stat.p3))
+    record = bytearray(index.data[entry.position:entry.next_position])
+    for pos, target in exits + passages:
+        record[pos] = 0
+    return BoardPatch(entry.position, entry.length + 2, exits, passages, hashlib.sha256(record).digest())
+
+def scan_world(filename, patches=True):
+    # Validates a world and lists the bytes to patch on each board. Runs in
+    # a worker process; only the small patch lists are sent back. Without
+    # patches, only the board lengths are walked and the patch lists are
+    # left empty.
+    try:
+        index = boardwalk.WorldIndex(filename)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (filename, e))
+    with index:
+        if len(index.data) < boardwalk.WORLD_HEADER_SIZE:
+            raise ValueError("%s: world header is truncated" % filename)
+        if patches:
+            boards = [scan_board(index, i, filename) for i in range(len(index))]
+        else:
+            boards = [check_board_length(index, i, filename) for i in range(len(index))]
+        end = boards[-1].position + boards[-1].length if boards else boardwalk.WORLD_HEADER_SIZE
+        return WorldScan(filename, bytes(index.data[:boardwalk.WORLD_HEADER_SIZE]), boards, end)
+
+def plan_join(scans, fixed_count=1, dedupe=False):
+    # With dedupe, a board whose record is identical to an earlier one once
+    # its IDs are moved is dropped and references to it go to the earlier
+    # copy. The first fixed_count boards are never dropped. Board 0 is never
+    # used as the surviving copy either, as an exit to board 0 means none.
+    survivor = []
+    survivors = {}
+    saved = 0
+    offset = 0
+    for scan in scans:
+        for board in scan.boards:
+            board_id = len(survivor)
+            survivor.append(board_id)
+            if (not dedupe) or (board_id == 0):
+                continue
+            key = (board.digest,
+                tuple((pos, target + offset) for pos, target in board.exits),
+                tuple((pos, target + offset) for pos, target in board.passages))
+            if (key in survivors) and (board_id >= fixed_count):
+                survivor[board_id] = survivors[key]
+                saved += board.length
+            else:
+                survivors.setdefault(key, board_id)
+        offset += len(scan.boards)
+    output_ids = {}
+    for board_id, kept in enumerate(survivor):
+        if board_id == kept:
+            output_ids[board_id] = len(output_ids)
+    remap = [output_ids[kept] for kept in survivor]
+    dropped = set(board_id for board_id, kept in enumerate(survivor) if board_id != kept)
+    return JoinPlan(remap, dropped, len(output_ids), saved)
 
+def move_id(plan, board_id):
+    # references past the joined boards are kept as they are
+    return plan.remap[board_id] if board_id < len(plan.remap) else board_id
 
+def check_limits(scans, plan, base_count=0):
+    # Raises ValueError if the joined world would not fit board IDs in a byte.
+    if plan.board_total > MAX_BOARDS:
+        raise ValueError("joined world would have %d boards, over the limit of %d" % (plan.board_total, MAX_BOARDS))
+    offset = base_count
+    for scan in scans:
+        for board_id, board in enumerate(scan.boards):
+            for pos, target in board.exits + board.passages:
+                if move_id(plan, target + offset) > MAX_BOARDS:
+                    raise ValueError("%s: board %d: reference to board %d would be out of range after joining"
+                        % (scan.filename, board_id, target + offset))
+        offset += len(scan.boards)
 
+def write_boards(f, scan, offset, plan):
+    # Copies the boards of a scanned world to f, skipping dropped boards and
+    # moving IDs up by offset (and onto kept copies).
+    with open(scan.filename, "rb") as src:
+        for board_id, board in enumerate(scan.boards):
+            if board_id + offset in plan.dropped:
+                continue
+            src.seek(board.position)
+            record = bytearray(src.read(board.length))
+            for pos, target in board.exits + board.passages:
+                record[pos] = move_id(plan, target + offset)
+            f.write(record)
 
+def scan_worlds(filenames, jobs=None):
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(scan_world, filenames))
+
+def join_worlds(filenames, output, jobs=None, dedupe=False):
+    # Writes a new world made of all boards of filenames; the header is
+    # taken from the first world. Returns the JoinPlan.
+    scans = scan_worlds(filenames, jobs)
+    plan = plan_join(scans, 1, dedupe)
+    check_limits(scans, plan)
+    header = bytearray(scans[0].header)
+    header[2:4] = pack("<H", max(plan.board_total - 1, 0))
+    current_board = unpack_from("<h", header, boardwalk.HEADER_CURRENT_BOARD)[0]
+    if current_board >= 0:
+        header[boardwalk.HEADER_CURRENT_BOARD:boardwalk.HEADER_CURRENT_BOARD + 2] = pack("<h", move_id(plan, current_board))
+    try:
+        with open(output + ".tmp", "wb") as f:
+            f.write(header)
+            offset = 0
+            for scan in scans:
+                write_boards(f, scan, offset, plan)
+                offset += len(scan.boards)
+    except BaseException:
+        os.unlink(output + ".tmp")
+        raise
+    os.replace(output + ".tmp", output)
+    return plan
+
+def append_worlds(filenames, output, jobs=None, dedupe=False):
+    # Writes the boards of filenames after the last board of the existing
+    # world output; its boards and header are kept, except for the board
+    # count, which is patched last. Returns the JoinPlan. The boards of
+    # output are only hashed for dedupe; otherwise just their lengths are
+    # walked, to find the end of the world.
+    if dedupe:
+        scans = scan_worlds([output] + filenames, jobs)
+    else:
+        scans = [scan_world(output, patches=False)] + scan_worlds(filenames, jobs)
+    existing = len(scans[0].boards)
+    plan = plan_join(scans, existing, dedupe)
+    check_limits(scans[1:], plan, existing)
+    with open(output, "r+b") as f:
+        f.seek(scans[0].end)
+        offset = existing
+        for scan in scans[1:]:
+            write_boards(f, scan, offset, plan)
+            offset += len(scan.boards)
+        f.truncate()
+        f.flush()
+        f.seek(2)
+        f.write(pack("<H", plan.board_total - 1))
+    return plan
+
+def main():
+    parser = argparse.ArgumentParser(description="Concatenate ZZT worlds.")
+    parser.add_argument("-j", "--jobs", type=int,
+        help="number of worker processes for reading worlds (default: CPU count)")
+    parser.add_argument("-a", "--append", action="store_true",
+        help="append the worlds to the existing output world instead of writing a new one")
+    parser.add_argument("-d", "--dedupe", action="store_true",
+        help="keep one copy of identical boards, pointing exits and passages to it")
+    parser.add_argument("worlds", nargs="+")
+    parser.add_argument("output")
+    args = parser.parse_args()
+
+    try:
+        if args.append:
+            plan = append_worlds(args.worlds, args.output, args.jobs, args.dedupe)
+        else:
+            plan = join_worlds(args.worlds, args.output, args.jobs, args.dedupe)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print("%s: %d boards" % (args.output, plan.board_total))
+    if args.dedupe:
+        print("%d duplicate boards dropped, %d bytes saved" % (len(plan.dropped), plan.saved))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Copyright (c) 2021 Adrian Siekierka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Usage: world_map.py --font FONT [-o OUTPUT] [-s START] world
+#
+# Lays the boards of a world out on a grid following their north/south/
+# west/east exits and writes the whole map as one PNG. The image is
+# rendered and compressed one row of boards at a time, so memory use
+# depends on the width of the map, not its size.
+
+#!/usr/bin/env python3
+from collections import deque
+from struct import pack, unpack_from
+import argparse, os, sys, zlib
+import numpy as np
+
+import boardwalk
+import zzt_render
+
+# (dx, dy) of the board_north, board_south, board_west and board_east exits
+EXIT_OFFSETS = [(0, -1), (0, 1), (-1, 0), (1, 0)]
+
+def layout_boards(exits, start):
+	# Places boards on a grid by walking the exits breadth-first from
+	# start; a board reached through a cell which is already taken is laid
+	# out from elsewhere, or starts a new group below the map. Returns
+	# {board: (x, y)} with non-negative coordinates.
+	positions = {}
+	order = [start] + [i for i in range(len(exits)) if i != start]
+	top = 0
+	for root in order:
+		if root in positions:
+			continue
+		group = {root: (0, 0)}
+		group_cells = {(0, 0): root}
+		queue = deque([root])
+		while queue:
+			board = queue.popleft()
+			x, y = group[board]
+			for target, (dx, dy) in zip(exits[board], EXIT_OFFSETS):
+				cell = (x + dx, y + dy)
+				if (target == 0) or (target >= len(exits)) or (target in positions) or (target in group) or (cell in group_cells):
+					continue
+				group[target] = cell
+				group_cells[cell] = target
+				queue.append(target)
+		min_x = min(x for x, y in group.values())
+		min_y = min(y for x, y in group.values())
+		max_y = max(y for x, y in group.values())
+		for board, (x, y) in group.items():
+			positions[board] = (x - min_x, y - min_y + top)
+		top += max_y - min_y + 1
+	return positions
+
+class PngWriter:
+	# Writes an 8-bit RGB PNG row by row.
+	def __init__(self, f, width, height):
+		self.f = f
+		self.width = width
+		self.compressor = zlib.compressobj(6)
+		f.write(b"\x89PNG\r\n\x1a\n")
+		self.chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+	def chunk(self, kind, data):
+		self.f.write(pack(">I", len(data)) + kind + data + pack(">I", zlib.crc32(kind + data)))
+
+	def write_rows(self, rows):
+		# rows: (count, width, 3) uint8 array; each row gets filter type 0
+		filtered = np.zeros((rows.shape[0], self.width * 3 + 1), dtype=np.uint8)
+		filtered[:, 1:] = rows.reshape(rows.shape[0], -1)
+		data = self.compressor.compress(filtered.tobytes())
+		if data:
+			self.chunk(b"IDAT", data)
+
+	def close(self):
+		self.chunk(b"IDAT", self.compressor.flush())
+		self.chunk(b"IEND", b"")
+
+def write_map(index, renderer, positions, f, log=print):
+	columns = max(x for x, y in positions.values()) + 1
+	rows = max(y for x, y in positions.values()) + 1
+	tile_height, tile_width = renderer.shape[:2]
+	by_cell = {pos: board for board, pos in positions.items()}
+	writer = PngWriter(f, columns * tile_width, rows * tile_height)
+	strip = np.empty((tile_height, columns * tile_width, 3), dtype=np.uint8)
+	for y in range(rows):
+		log("row %d/%d" % (y + 1, rows))
+		strip.fill(0)
+		for x in range(columns):
+			board = by_cell.get((x, y))
+			if board is not None:
+				renderer.render(index.decode_board(board), False, strip[:, x * tile_width:(x + 1) * tile_width])
+		writer.write_rows(strip)
+	writer.close()
+	return columns, rows
+
+def main():
+	parser = argparse.ArgumentParser(description="Render a ZZT world as one map image, following board exits.")
+	parser.add_argument("--font", required=True, metavar="FILE",
+		help="8xN CP437 font (raw bitmap or 16x16 glyph image)")
+	parser.add_argument("-o", "--output", metavar="FILE",
+		help="output PNG (default: <world>.map.png)")
+	parser.add_argument("-s", "--start", type=int, metavar="ID",
+		help="board to place first (default: the world's starting board)")
+	parser.add_argument("world")
+	args = parser.parse_args()
+
+	output = args.output or (os.path.splitext(os.path.basename(args.world))[0] + ".map.png")
+	renderer = zzt_render.BoardRenderer(zzt_render.load_font(args.font))
+	try:
+		index = boardwalk.WorldIndex(args.world)
+	except (OSError, ValueError) as e:
+		print("%s: error: %s" % (args.world, e), file=sys.stderr)
+		sys.exit(1)
+	with index:
+		if len(index) == 0:
+			print("%s: no boards" % args.world, file=sys.stderr)
+			sys.exit(1)
+		start = args.start
+		if start is None:
+			start = 0
+			if len(index.data) >= boardwalk.HEADER_CURRENT_BOARD + 2:
+				start = unpack_from("<h", index.data, boardwalk.HEADER_CURRENT_BOARD)[0]
+		if (start < 0) or (start >= len(index)):
+			start = 0
+		exits = [index.exits(i) or [0, 0, 0, 0] for i in range(len(index))]
+		positions = layout_boards(exits, start)
+		with open(output, "wb") as f:
+			columns, rows = write_map(index, renderer, positions, f)
+	print("%s: %d boards on a %dx%d grid" % (output, len(positions), columns, rows))
+
+if __name__ == "__main__":
+	main()
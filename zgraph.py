@@ -20,73 +20,277 @@
 
 #!/usr/bin/env python3
 
+import argparse
 import colorsys
+import json
+import math
 import os
 import queue
 import sys
+from collections import namedtuple
+from struct import unpack_from
+from xml.sax.saxutils import escape, quoteattr
 
-import zookeeper
+import boardwalk
 import networkx as nx
-import pygraphviz as viz
+try:
+	import pygraphviz as viz
+except ImportError:
+	viz = None
 
-def has_path_from_start(board_graph, world, c):
-	for idx in c:
-		if nx.has_path(board_graph, world.world.current_board, idx):
-			return True
-	return False
+FORMATS = ["png", "svg", "dot", "json", "graphml"]
 
-def main():
-	world = zookeeper.Zookeeper(sys.argv[-1])
+# exits are [north, south, west, east] (0 means none); passages lists the
+# destination (param3) of each passage on the board
+BoardLinks = namedtuple("BoardLinks", ["title", "exits", "passages"])
+
+# SVG layout: board box size and the gaps between boards, groups and layers
+SVG_NODE_WIDTH = 180
+SVG_NODE_HEIGHT = 24
+SVG_NODE_GAP = 8
+SVG_GROUP_PADDING = 10
+SVG_GROUP_GAP = 24
+SVG_LAYER_GAP = 48
+SVG_FONT_SIZE = 11
+
+def scan_world(filename):
+	# Reads the title, exits and passage destinations of every board. Only
+	# the run lengths of the tiles are walked, to find the board info and
+	# stat table and the element under each stat. Returns (current board,
+	# [BoardLinks]).
+	with boardwalk.WorldIndex(filename) as index:
+		current_board = 0
+		if len(index.data) >= boardwalk.HEADER_CURRENT_BOARD + 2:
+			current_board = unpack_from("<h", index.data, boardwalk.HEADER_CURRENT_BOARD)[0]
+		boards = []
+		for idx in range(len(index)):
+			stats = [stat for pos, stat, code in index.iter_stats(idx)]
+			elements = index.elements_at(idx, [(stat.x, stat.y) for stat in stats])
+			passages = [stat.p3 for stat, element in zip(stats, elements) if element == boardwalk.E_PASSAGE]
+			boards.append(BoardLinks(index.title(idx), index.exits(idx) or [0, 0, 0, 0], passages))
+	return current_board, boards
+
+def build_board_graph(boards, current_board):
 	board_graph = nx.DiGraph()
-	board_names = {}
-	backtracking_number = 1
-	for idx in range(0, world.world.total_boards):
-		board: zookeeper.Board = world.boards[idx]
+	for idx, board in enumerate(boards):
 		board_graph.add_node(idx, label=board.title, style="filled", fillcolor="white")
-		if idx == world.world.current_board:
+		if idx == current_board:
 			board_graph.nodes[idx]["style"] = "filled, bold"
-		board_names[idx] = board.title
-		if board.board_north > 0:
-			board_graph.add_edge(idx, board.board_north)
-		if board.board_south > 0:
-			board_graph.add_edge(idx, board.board_south)
-		if board.board_west > 0:
-			board_graph.add_edge(idx, board.board_west)
-		if board.board_east > 0:
-			board_graph.add_edge(idx, board.board_east)
-		for stat in board.stat_data:
-			element: zookeeper.Element = board.get_element((stat.x, stat.y))
-			if element.oop_name.casefold() == 'PASSAGE'.casefold():
-				board_graph.add_edge(idx, stat.param3, style="dashed")
-
-	clique_graph = nx.Graph()
-	for idx in range(0, world.world.total_boards):
-		board: zookeeper.Board = world.boards[idx]
-		results = {idx: True}
-		clique_graph.add_node(idx)
-		clique_graph.add_edge(idx, idx)
-		for idx2 in range(0, world.world.total_boards):
-			if idx2 != idx and nx.has_path(board_graph, idx, idx2) and nx.has_path(board_graph, idx2, idx):
-				results[idx2] = True
-				clique_graph.add_edge(idx, idx2)
-		board_graph.add_node(idx, label=board.title + (" (%d)" % (len(results))))
-		backtracking_number = max(backtracking_number, len(results))
-
-	cliques = list(sorted(filter(lambda x: has_path_from_start(board_graph, world, x), nx.find_cliques(clique_graph))))
-	hsv_fillcolors = [(x / len(cliques), 0.3, 0.9) for x in range(len(cliques))]
+		for target in board.exits:
+			if target > 0:
+				board_graph.add_edge(idx, target)
+		for target in board.passages:
+			board_graph.add_edge(idx, target, style="dashed")
+	return board_graph
+
+def find_groups(board_graph, boards, start):
+	# Boards which can all reach each other are the strongly connected
+	# components of the board graph. Returns (components, groups,
+	# backtracking number): components maps each board to its sorted
+	# component, groups lists the components reachable from start, sorted.
+	components = {}
+	for c in nx.strongly_connected_components(board_graph):
+		c = sorted(c)
+		for idx in c:
+			components[idx] = c
+	reachable = set()
+	if start in board_graph:
+		reachable = nx.descendants(board_graph, start) | {start}
+	groups = []
+	for idx in boards:
+		c = components[idx]
+		if (c[0] == idx) and any(i in reachable for i in c):
+			groups.append(c)
+	backtracking_number = max([1] + [len(components[idx]) for idx in boards])
+	return components, sorted(groups), backtracking_number
+
+def group_colors(groups):
+	hsv_fillcolors = [(x / len(groups), 0.3, 0.9) for x in range(len(groups))]
 	rgb_fillcolors = list(map(lambda x: colorsys.hsv_to_rgb(*x), hsv_fillcolors))
+	return ["#%02x%02x%02x" % (round(r * 255), round(g * 255), round(b * 255)) for r, g, b in rgb_fillcolors]
+
+def build_condensation(board_graph, components, board_names):
+	# One node per component; the edges between them form a DAG showing the
+	# order in which parts of the world can be reached. Returns the DAG and
+	# a map from boards to its nodes.
+	members = list({id(c): c for c in components.values()}.values())
+	dag = nx.condensation(board_graph, scc=members)
+	mapping = dag.graph.pop("mapping")
+	for node in dag.nodes:
+		c = sorted(dag.nodes[node]["members"])
+		dag.nodes[node]["label"] = "\n".join("%d: %s" % (i, board_names.get(i, "?")) for i in c)
+		dag.nodes[node]["style"] = "filled"
+		dag.nodes[node]["fillcolor"] = "white"
+		del dag.nodes[node]["members"]
+	return dag, mapping
+
+def dot_id(value):
+	# backslashes are escaped too, so titles are not read as label escapes
+	# and a trailing one cannot escape the closing quote
+	return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def write_dot(graph, filename):
+	# Writes graph in Graphviz DOT syntax, without laying it out.
+	with open(filename, "w", encoding="utf-8") as f:
+		f.write("digraph {\n")
+		for node, attrs in graph.nodes(data=True):
+			f.write("\t%s [%s];\n" % (dot_id(node), ", ".join("%s=%s" % (k, dot_id(v)) for k, v in attrs.items())))
+		for src, dst, attrs in graph.edges(data=True):
+			attr_text = ", ".join("%s=%s" % (k, dot_id(v)) for k, v in attrs.items())
+			f.write("\t%s -> %s%s;\n" % (dot_id(src), dot_id(dst), (" [%s]" % attr_text) if attr_text else ""))
+		f.write("}\n")
+
+def write_json(board_graph, dag, dag_nodes, filename):
+	members = {}
+	for board, node in sorted(dag_nodes.items()):
+		members.setdefault(node, []).append(board)
+	with open(filename, "w", encoding="utf-8") as f:
+		json.dump({
+			"boards": [dict(attrs, id=node, group=dag_nodes[node]) for node, attrs in board_graph.nodes(data=True)],
+			"edges": [dict(attrs, source=src, target=dst) for src, dst, attrs in board_graph.edges(data=True)],
+			"groups": [{"id": node, "boards": members[node], "fillcolor": dag.nodes[node]["fillcolor"]} for node in dag.nodes],
+			"group_edges": [[src, dst] for src, dst in dag.edges],
+		}, f, indent=1)
 
-	for cid in range(0, len(cliques)):
-		c = cliques[cid]
-		fillcolor = "#%02x%02x%02x" % (round(rgb_fillcolors[cid][0] * 255), round(rgb_fillcolors[cid][1] * 255), round(rgb_fillcolors[cid][2] * 255))
+def layered_layout(board_graph, dag, dag_nodes):
+	# Places each group (condensation node) on the layer of its longest path
+	# from a source; within a layer, groups are ordered by the mean position
+	# of their predecessors. Boards of a group are laid out in a grid inside
+	# its box. Returns ({board: (x, y)}, {group: (x, y, width, height)},
+	# (width, height)).
+	members = {}
+	for board, node in dag_nodes.items():
+		members.setdefault(node, []).append(board)
+	layer_of = {}
+	for node in nx.topological_sort(dag):
+		layer_of[node] = max([layer_of[p] + 1 for p in dag.predecessors(node)] + [0])
+	layers = [[] for i in range(max(layer_of.values(), default=-1) + 1)]
+	for node in sorted(dag.nodes, key=lambda n: min(members[n])):
+		layers[layer_of[node]].append(node)
+
+	sizes = {}
+	for node, boards in members.items():
+		columns = math.ceil(math.sqrt(len(boards)))
+		rows = math.ceil(len(boards) / columns)
+		sizes[node] = (columns, columns * (SVG_NODE_WIDTH + SVG_NODE_GAP) - SVG_NODE_GAP + 2 * SVG_GROUP_PADDING,
+			rows * (SVG_NODE_HEIGHT + SVG_NODE_GAP) - SVG_NODE_GAP + 2 * SVG_GROUP_PADDING)
+
+	order = {}
+	group_boxes = {}
+	y = SVG_GROUP_GAP
+	rows = []
+	for layer in layers:
+		def barycenter(node):
+			preds = [order[p] for p in dag.predecessors(node) if p in order]
+			return (sum(preds) / len(preds)) if preds else min(members[node])
+		layer.sort(key=barycenter)
+		for i, node in enumerate(layer):
+			order[node] = i
+		row_width = sum(sizes[n][1] for n in layer) + SVG_GROUP_GAP * (len(layer) - 1)
+		row_height = max(sizes[n][2] for n in layer)
+		rows.append((layer, row_width, y))
+		y += row_height + SVG_LAYER_GAP
+	width = max([r[1] for r in rows] + [0]) + 2 * SVG_GROUP_GAP
+	height = y - SVG_LAYER_GAP + SVG_GROUP_GAP
+
+	positions = {}
+	for layer, row_width, y in rows:
+		x = (width - row_width) / 2
+		for node in layer:
+			columns, box_width, box_height = sizes[node]
+			group_boxes[node] = (x, y, box_width, box_height)
+			for i, board in enumerate(sorted(members[node])):
+				positions[board] = (x + SVG_GROUP_PADDING + (i % columns) * (SVG_NODE_WIDTH + SVG_NODE_GAP),
+					y + SVG_GROUP_PADDING + (i // columns) * (SVG_NODE_HEIGHT + SVG_NODE_GAP))
+			x += box_width + SVG_GROUP_GAP
+	return positions, group_boxes, (width, height)
+
+def write_svg(board_graph, dag, dag_nodes, start, filename):
+	positions, group_boxes, (width, height) = layered_layout(board_graph, dag, dag_nodes)
+	out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="sans-serif" font-size="%d">'
+		% (width, height, SVG_FONT_SIZE)]
+	out.append('<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="6" markerHeight="6" orient="auto">'
+		'<path d="M0,0 L10,5 L0,10 z"/></marker></defs>')
+	out.append('<rect width="100%" height="100%" fill="white"/>')
+	for node, (x, y, w, h) in group_boxes.items():
+		out.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" rx="6" fill="none" stroke="#999999"/>' % (x, y, w, h))
+	for src, dst, attrs in board_graph.edges(data=True):
+		if src == dst:
+			continue
+		sx, sy = positions[src]
+		dx, dy = positions[dst]
+		sx += SVG_NODE_WIDTH / 2
+		dx += SVG_NODE_WIDTH / 2
+		if dy > sy:
+			sy += SVG_NODE_HEIGHT
+		elif dy < sy:
+			dy += SVG_NODE_HEIGHT
+		out.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="#555555" marker-end="url(#arrow)"%s/>'
+			% (sx, sy, dx, dy, ' stroke-dasharray="4,3"' if attrs.get("style") == "dashed" else ""))
+	for board, (x, y) in positions.items():
+		attrs = board_graph.nodes[board]
+		label = attrs.get("label", str(board))
+		out.append('<rect x="%.1f" y="%.1f" width="%d" height="%d" fill=%s stroke="black" stroke-width="%d"/>'
+			% (x, y, SVG_NODE_WIDTH, SVG_NODE_HEIGHT, quoteattr(attrs.get("fillcolor", "white")), 3 if board == start else 1))
+		out.append('<text x="%.1f" y="%.1f" text-anchor="middle" dominant-baseline="central"><title>%s</title>%s</text>'
+			% (x + SVG_NODE_WIDTH / 2, y + SVG_NODE_HEIGHT / 2, escape("%d: %s" % (board, label)),
+			escape(label if len(label) <= 28 else label[:27] + "\u2026")))
+	out.append("</svg>")
+	with open(filename, "w", encoding="utf-8") as f:
+		f.write("\n".join(out) + "\n")
+
+def main():
+	parser = argparse.ArgumentParser(description="Draw the board graph of a ZZT world.")
+	parser.add_argument("-f", "--format", choices=FORMATS, default="png",
+		help="png (laid out by pygraphviz), svg (built-in layout) or dot, json, graphml (no layout); default: png")
+	parser.add_argument("-o", "--output", metavar="FILE",
+		help="output file (default: graph.<format>); the condensation DAG goes next to it with a _condensation suffix")
+	parser.add_argument("world")
+	args = parser.parse_args()
+	if (args.format == "png") and (viz is None):
+		parser.error("pygraphviz is not installed; use -f svg, dot, json or graphml")
+	output = args.output or ("graph." + args.format)
+	output_condensation = "%s_condensation%s" % os.path.splitext(output)
+
+	try:
+		start, links = scan_world(args.world)
+	except (OSError, ValueError) as e:
+		print("%s: error: %s" % (args.world, e), file=sys.stderr)
+		sys.exit(1)
+	board_graph = build_board_graph(links, start)
+	boards = range(0, len(links))
+	board_names = {idx: board.title for idx, board in enumerate(links)}
+
+	components, groups, backtracking_number = find_groups(board_graph, boards, start)
+	for idx in boards:
+		board_graph.add_node(idx, label=board_names[idx] + (" (%d)" % (len(components[idx]))))
+
+	dag, dag_nodes = build_condensation(board_graph, components, board_names)
+	for c, fillcolor in zip(groups, group_colors(groups)):
 		for i in c:
 			board_graph.nodes[i]['fillcolor'] = fillcolor
+		dag.nodes[dag_nodes[c[0]]]["fillcolor"] = fillcolor
+
+	if args.format == "png":
+		board_agraph = nx.drawing.nx_agraph.to_agraph(board_graph)
+		# board_agraph.graph_attr["rankdir"] = "LR"
+		board_agraph.add_subgraph([start, 0], rank="same")
+		board_agraph.layout('dot')
+		board_agraph.draw(output)
 
-	board_agraph = nx.drawing.nx_agraph.to_agraph(board_graph)
-	# board_agraph.graph_attr["rankdir"] = "LR"
-	board_agraph.add_subgraph([world.world.current_board, 0], rank="same")
-	board_agraph.layout('dot')
-	board_agraph.draw("graph.png")
+		dag_agraph = nx.drawing.nx_agraph.to_agraph(dag)
+		dag_agraph.layout('dot')
+		dag_agraph.draw(output_condensation)
+	elif args.format == "svg":
+		write_svg(board_graph, dag, dag_nodes, start, output)
+	elif args.format == "dot":
+		write_dot(board_graph, output)
+		write_dot(dag, output_condensation)
+	elif args.format == "json":
+		write_json(board_graph, dag, dag_nodes, output)
+	elif args.format == "graphml":
+		nx.write_graphml(board_graph, output)
+		nx.write_graphml(dag, output_condensation)
 
 	print(f"Backtracking number: {backtracking_number}")
 
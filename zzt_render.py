@@ -0,0 +1,179 @@
+# Copyright (c) 2021 Adrian Siekierka
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# Renders ZZT boards to RGB arrays with NumPy.
+#
+# A glyph atlas holding every character of the font drawn in each of the 16
+# palette colours (and its complement, for backgrounds) is built once; a
+# board is then drawn with two gathers from it, indexed by the per-tile
+# character and colour arrays.
+import numpy as np
+from boardwalk import BOARD_TILES
+
+BOARD_WIDTH = 60
+BOARD_HEIGHT = 25
+
+EGA_PALETTE = [
+	(0x00, 0x00, 0x00), (0x00, 0x00, 0xAA), (0x00, 0xAA, 0x00), (0x00, 0xAA, 0xAA),
+	(0xAA, 0x00, 0x00), (0xAA, 0x00, 0xAA), (0xAA, 0x55, 0x00), (0xAA, 0xAA, 0xAA),
+	(0x55, 0x55, 0x55), (0x55, 0x55, 0xFF), (0x55, 0xFF, 0x55), (0x55, 0xFF, 0xFF),
+	(0xFF, 0x55, 0x55), (0xFF, 0x55, 0xFF), (0xFF, 0xFF, 0x55), (0xFF, 0xFF, 0xFF),
+]
+
+E_EMPTY = 0
+E_PLAYER = 4
+E_DUPLICATOR = 12
+E_BOMB = 13
+E_TRANSPORTER = 30
+E_LINE = 31
+E_OBJECT = 36
+E_PUSHER = 40
+E_TEXT_BLUE = 47
+E_TEXT_WHITE = 53
+
+# default character of each element (animated elements use their first frame)
+ELEMENT_CHARS = np.zeros(256, dtype=np.uint8)
+ELEMENT_CHARS[:54] = [
+	0x20, 0x20, 0x20, 0x20, 0x02, 0x84, 0x9D, 0x04, 0x0C, 0x0A, 0xE8, 0xF0, 0xFA, 0x0B, 0x7F, 0xB3,
+	0xB3, 0x5C, 0xF8, 0xB0, 0xB0, 0xDB, 0xB2, 0xB1, 0xFE, 0x12, 0x1D, 0xB2, 0x20, 0xCE, 0xC5, 0xCE,
+	0x2A, 0xCD, 0x99, 0x05, 0x02, 0x2A, 0x5E, 0x18, 0x10, 0xEA, 0xE3, 0xBA, 0xE9, 0x4F, 0x3F, 0x20,
+	0x20, 0x20, 0x20, 0x20, 0x20, 0x20,
+]
+# line wall character by neighbour mask (north 1, south 2, west 4, east 8)
+LINE_CHARS = np.frombuffer(b"\xF9\xD0\xD2\xBA\xB5\xBC\xBB\xB9\xC6\xC8\xC9\xCC\xCD\xCA\xCB\xCE", dtype=np.uint8)
+DUPLICATOR_CHARS = [0xFA, 0xFA, 0xF9, 0xF8, 0x6F, 0x4F]
+
+def load_font(filename):
+	# Loads an 8-pixel wide font, either as a raw bitmap (256 glyphs of one
+	# byte per row, as in .CHR/.COM font files) or as an image holding a
+	# 16x16 grid of glyphs. Returns a (256, height, 8) boolean array.
+	with open(filename, "rb") as f:
+		data = f.read()
+	if data[:8] == b"\x89PNG\r\n\x1a\n" or data[:2] == b"BM":
+		from PIL import Image
+		img = np.asarray(Image.open(filename).convert("L"))
+		height = img.shape[0] // 16
+		width = img.shape[1] // 16
+		glyphs = img[:height * 16, :width * 16].reshape(16, height, 16, width).transpose(0, 2, 1, 3)
+		return (glyphs.reshape(256, height, width) > 127)[:, :, :8]
+	if (len(data) == 0) or (len(data) % 256 != 0):
+		raise ValueError("%s: not a font (%d bytes)" % (filename, len(data)))
+	rows = np.frombuffer(data, dtype=np.uint8).reshape(256, len(data) // 256)
+	return np.unpackbits(rows[:, :, np.newaxis], axis=2).astype(bool)
+
+class BoardRenderer:
+	# Not thread-safe: render() reuses per-renderer scratch buffers, so use
+	# one renderer per thread.
+	def __init__(self, font, palette=EGA_PALETTE, blink=True):
+		self.font = np.asarray(font, dtype=bool)
+		self.glyph_height = self.font.shape[1]
+		self.glyph_width = self.font.shape[2]
+		self.blink = blink
+		palette = np.asarray(palette, dtype=np.uint8)
+		mask = self.font[:, np.newaxis, :, :, np.newaxis]
+		colors = palette[np.newaxis, :, np.newaxis, np.newaxis, :]
+		# flattened to (glyph * 16 + color, height, width, 3)
+		shape = (256 * 16, self.glyph_height, self.glyph_width, 3)
+		self.fg_atlas = np.where(mask, colors, 0).astype(np.uint8).reshape(shape)
+		self.bg_atlas = np.where(mask, 0, colors).astype(np.uint8).reshape(shape)
+		self.shape = (BOARD_HEIGHT * self.glyph_height, BOARD_WIDTH * self.glyph_width, 3)
+		self._fg = np.empty((BOARD_TILES,) + shape[1:], dtype=np.uint8)
+		self._bg = np.empty((BOARD_TILES,) + shape[1:], dtype=np.uint8)
+		self._fg_index = np.empty(BOARD_TILES, dtype=np.intp)
+		self._bg_index = np.empty(BOARD_TILES, dtype=np.intp)
+
+	def tiles(self, board, title_screen=False):
+		# Returns the (25, 60) character and colour arrays of a
+		# boardwalk.DecodedBoard as ZZT would draw it. With title_screen,
+		# the player is hidden and the tile under it is shown instead.
+		elements = np.frombuffer(bytes(board.elements), dtype=np.uint8).reshape(BOARD_HEIGHT, BOARD_WIDTH).copy()
+		colors = np.frombuffer(bytes(board.colors), dtype=np.uint8).reshape(BOARD_HEIGHT, BOARD_WIDTH).copy()
+		stats = [s for s in board.stats if (1 <= s.x <= BOARD_WIDTH) and (1 <= s.y <= BOARD_HEIGHT)]
+		if title_screen and (len(board.stats) > 0) and (board.stats[0] in stats):
+			player = board.stats[0]
+			if elements[player.y - 1, player.x - 1] == E_PLAYER:
+				elements[player.y - 1, player.x - 1] = player.under_element
+				colors[player.y - 1, player.x - 1] = player.under_color
+
+		chars = ELEMENT_CHARS[elements]
+		# text: the colour byte is the character, the element the colour
+		text = (elements >= E_TEXT_BLUE) & (elements <= E_TEXT_WHITE)
+		chars[text] = colors[text]
+		colors[text] = np.where(elements[text] == E_TEXT_WHITE, 0x0F, ((elements[text] - E_TEXT_BLUE + 1) << 4) | 0x0F)
+		colors[elements == E_EMPTY] = 0x0F
+
+		# line walls join with neighbouring lines and the board edge
+		line = np.pad(elements == E_LINE, 1, constant_values=True)
+		is_line = line[1:-1, 1:-1]
+		mask = line[:-2, 1:-1] * 1 + line[2:, 1:-1] * 2 + line[1:-1, :-2] * 4 + line[1:-1, 2:] * 8
+		chars[is_line] = LINE_CHARS[mask[is_line]]
+
+		# elements whose character depends on their stat
+		for stat in stats:
+			x = stat.x - 1
+			y = stat.y - 1
+			element = elements[y, x]
+			if element == E_OBJECT:
+				chars[y, x] = stat.p1
+			elif element == E_BOMB:
+				chars[y, x] = 0x0B if stat.p1 <= 1 else 0x30 + (stat.p1 % 10)
+			elif element == E_DUPLICATOR:
+				chars[y, x] = DUPLICATOR_CHARS[stat.p1] if stat.p1 < len(DUPLICATOR_CHARS) else 0xFA
+			elif element == E_PUSHER:
+				chars[y, x] = 0x10 if stat.step_x > 0 else 0x11 if stat.step_x < 0 else 0x1E if stat.step_y < 0 else 0x1F
+			elif element == E_TRANSPORTER:
+				if stat.step_x == 0:
+					chars[y, x] = 0x5E if stat.step_y < 0 else 0x76
+				else:
+					chars[y, x] = 0x28 if stat.step_x < 0 else 0x29
+		return chars, colors
+
+	def render(self, board, title_screen=False, out=None):
+		# Returns the board as a (height, width, 3) uint8 RGB array, written
+		# into out if given.
+		chars, colors = self.tiles(board, title_screen)
+		return self.render_tiles(chars, colors, out)
+
+	def render_tiles(self, chars, colors, out=None):
+		if out is None:
+			out = np.empty(self.shape, dtype=np.uint8)
+		chars = chars.astype(np.intp).ravel()
+		colors = colors.ravel()
+		np.multiply(chars, 16, out=self._fg_index)
+		np.add(self._fg_index, colors & 0x0F, out=self._fg_index)
+		np.multiply(chars, 16, out=self._bg_index)
+		np.add(self._bg_index, (colors >> 4) & (0x07 if self.blink else 0x0F), out=self._bg_index)
+		np.take(self.fg_atlas, self._fg_index, axis=0, out=self._fg)
+		np.take(self.bg_atlas, self._bg_index, axis=0, out=self._bg)
+		# (tile row, tile column, y, x) -> (tile row, y, tile column, x)
+		view = out.reshape(BOARD_HEIGHT, self.glyph_height, BOARD_WIDTH, self.glyph_width, 3).transpose(0, 2, 1, 3, 4)
+		np.add(self._fg.reshape(view.shape), self._bg.reshape(view.shape), out=view)
+		return out
+
+	def render_many(self, boards, title_screen=False, out=None):
+		# Renders a sequence of boards into one (count, height, width, 3)
+		# array, allocated once (or passed in as out).
+		boards = list(boards)
+		if out is None:
+			out = np.empty((len(boards),) + self.shape, dtype=np.uint8)
+		for i, board in enumerate(boards):
+			self.render(board, title_screen, out[i])
+		return out